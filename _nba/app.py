@@ -1,31 +1,66 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import re
+import gc
+import json
+import logging
 import pandas as pd
 import numpy as np
 import statistics
 
 import dash
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import dash_core_components as dcc
 import dash_html_components as html
+import dash_table
 import plotly.graph_objs as go
 from flask import Flask
 
 from teams import TEAMS
-from court import court_plot
+from court import COURT_LAYOUT, bin_shots
 from shared_config import authorized_app_emails
-from shared_modules import SqlConnection
+from shared_modules import ConnectionPool
+from query_cache import QueryCache
+from cache_backends import create_backend
+from roster_index import RosterIndex
+from prewarm import Prewarmer
 
 from nba_settings import player_img_url, team_img_url
 
 from app_styles import DEFAULT_IMAGE, HEADER_STYLE, TABLE_STYLE, SELECTED_TAB_STYLE, \
-    SINGLE_TAB_STYLE, ALL_TAB_STYLE, EVENT_DEFINITIONS
+    SINGLE_TAB_STYLE, ALL_TAB_STYLE, EVENT_DEFINITIONS, SHOT_TABLE_HEADER_STYLE, SHOT_TABLE_CELL_STYLE, \
+    SHOT_TABLE_STRIPE_STYLE
+
+from sql_queries import league_roster_query, player_shots_query, team_shots_query, \
+    team_season_stats_query, player_season_shooting_query, position_clusters_query
+
+CURRENT_SEASON = '2019-2020'
+IMPORT_BUDGET = float(os.environ.get('NBA_IMPORT_BUDGET', 5))
+PREWARM_ON_START = os.environ.get('NBA_PREWARM_ON_START', '1') == '1'
+SHOT_PAGE_SIZE = 5000
+SHOT_TABLE_PAGE_SIZE = 15
+
+# above this many shots the chart shows court bins instead of every shot
+SHOT_BIN_THRESHOLD = 2000
+SHOT_BIN_MARKER_SIZE = 14
 
-from sql_queries import team_roster_query, shot_chart_query, team_compare_query, team_trend_query, \
-    SHOT_PLOT_COLUMNS, TEAM_STATS_COLUMNS, CURRENT_ROSTER_COLUMNS, player_shooting_stats_query, \
-    SHOOTING_STATS_COLUMNS, position_clusters_query, POSITION_CLUSTERS_COLUMNS
+SHOT_TABLE_COLUMNS = ['Player', 'G', 'GS', 'FGM', 'FGA', 'FG%', 'FTM', 'FTA', 'FT%', 'PIP', 'PIPM', 'PIPA', 'PIP%', 'PTS',
+                      '3PM', '3PA', '3P%']
+
+# DataTable filter operators and the one each maps to, comparisons are named after the pandas method
+FILTER_OPERATORS = {'ge': 'ge', '>=': 'ge', 'le': 'le', '<=': 'le', 'lt': 'lt', '<': 'lt', 'gt': 'gt', '>': 'gt',
+                    'ne': 'ne', '!=': 'ne', 'eq': 'eq', '=': 'eq', 'contains': 'contains',
+                    'datestartswith': 'datestartswith'}
+FILTER_COMPARISONS = ['ge', 'le', 'lt', 'gt', 'ne', 'eq']
+# `{column} operator value`, the operator is the word right after the column so values can contain any of them
+FILTER_PART_PATTERN = re.compile(r'\s*\{(.+?)\}\s*(\S+)\s+(.*)')
 
 server = Flask(__name__)
-sql = SqlConnection('NBA')
+sql = ConnectionPool('NBA')
+cache = QueryCache(sql, backend=create_backend())
 
 app = dash.Dash(
     name='nba_app',
@@ -99,13 +134,12 @@ position_reference = pd.DataFrame(
 
 def player_card(player):
     rows = []
-    rosters = get_roster()
-    df = rosters[rosters['player_id'] == str(player)]
+    details = get_roster_index().player(player)
 
-    if len(df) > 0:
-        df = df[['Height', 'Weight', 'Position', 'DoB',
-                 'Age', 'Experience', 'School']].copy()
-        df = pd.DataFrame({'Metric': df.columns, 'Value': df.iloc[-1].values})
+    df = pd.DataFrame(columns=['Metric', 'Value'])
+    if details is not None:
+        metrics = ['Height', 'Weight', 'Position', 'DoB', 'Age', 'Experience', 'School']
+        df = pd.DataFrame({'Metric': metrics, 'Value': [details[m] for m in metrics]})
 
     for i in range(len(df)):
         row = []
@@ -140,13 +174,9 @@ def current_roster(team_id=None):
 
 
 def player_image(player):
-    rosters = get_roster()
-
     if player != '':
         img = get_player_img(player)
-
-        name = rosters.loc[rosters['player_id'] == player, 'Player']
-        name = name.iloc[0] if len(name) > 0 else 'Name Missing'
+        name = get_roster_index().player_name(player)
 
         return html.Div(children=[
             html.Img(src=str(img), style={
@@ -158,26 +188,16 @@ def player_image(player):
             className='container', style={'width': '100%', 'height': '100%', 'position': 'relative'})
 
 
-def build_table(df, table_setting='Player Summary', url_id=None):
+def build_table(df, table_setting='Player Summary'):
     if df is None:
         return []
 
     rows = []
-    for i in range(len(df)):
+    for i, record in enumerate(df.itertuples(index=False, name=None)):
         row = []
-        for col in df.columns:
-
+        for value in record:
             if table_setting == 'Player Summary':
-                value = player_image(df.iloc[i][col])
-
-            elif table_setting == 'Shot Summary' and col == 'Player':
-                player = df.iloc[i][col]
-                value = dcc.Link(html.P(player,
-                                        id='player-shots-' + str(player),
-                                        style={'font-size': '12px', 'color': 'darkgrey', 'font-weight': 'bold', 'border': 'none'}),
-                                 href='/player/' + str(url_id))
-            else:
-                value = df.iloc[i][col]
+                value = player_image(value)
 
             style = {'align': 'center', 'padding': '3px',
                      'text-align': 'center', 'font-size': '12px'}
@@ -188,121 +208,217 @@ def build_table(df, table_setting='Player Summary', url_id=None):
 
         rows.append(html.Tr(row))
 
-    if table_setting == 'Shot Summary':
-        SHOT_HEADER_STYLE = {
-            'align': 'center',
-            'width': '150px',
-            'background-color': '#0f6db5',
-            'text-align': 'center',
-            'font-size': '14px',
-            'padding': '10px',
-            'color': '#ffffff'}
-
-        return html.Table(
-            [html.Tr([html.Th(col, style=SHOT_HEADER_STYLE) for col in df.columns])] + rows, style=TABLE_STYLE)
-
     return html.Table(
         [html.Tr([html.Th(col, style=HEADER_STYLE) for col in df.columns])] + rows, style=TABLE_STYLE)
 
 
-def get_shots(stat_id, stat_type):
+def shot_table(team_id, season=CURRENT_SEASON):
+    """
+    the team's shooting stats as a DataTable, paged, sorted and filtered on the server by update_shot_table
+    only the rows of the current page are sent to the browser
+    """
+    return html.Div([
+        dcc.Store(id='shot_table_params', data={'team_id': str(team_id), 'season': season}),
+        dash_table.DataTable(
+            id='shot_table',
+            columns=[{'name': c, 'id': c} for c in SHOT_TABLE_COLUMNS],
+            page_current=0,
+            page_size=SHOT_TABLE_PAGE_SIZE,
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='multi',
+            sort_by=[],
+            filter_action='custom',
+            filter_query='',
+            style_header=SHOT_TABLE_HEADER_STYLE,
+            style_cell=SHOT_TABLE_CELL_STYLE,
+            style_data_conditional=SHOT_TABLE_STRIPE_STYLE
+        )
+    ])
+
+
+def split_filter_part(filter_part):
+    match = FILTER_PART_PATTERN.match(filter_part)
+    if match is None or match.group(2) not in FILTER_OPERATORS:
+        return [None] * 4
+
+    name, operator, value_part = match.groups()
+
+    # the value as typed, and as a number when it's an unquoted one
+    value_part = value_part.strip()
+    if len(value_part) > 1 and value_part[0] == value_part[-1] and value_part[0] in ('\'', '"', '`'):
+        text = value_part[1: -1].replace('\\' + value_part[0], value_part[0])
+        value = text
+    else:
+        text = value_part
+        try:
+            value = float(value_part)
+        except ValueError:
+            value = value_part
+
+    return name, FILTER_OPERATORS[operator], value, text
+
+
+def filter_frame(df, filter_query):
+    """
+    applies a DataTable filter query such as `{PTS} > 100 && {Player} contains Le` as vectorized masks
+    numeric columns are compared with numbers and the others as text, a part comparing a numeric column with text
+    is ignored
+    """
+    for filter_part in (filter_query or '').split(' && '):
+        name, operator, value, text = split_filter_part(filter_part)
+        if name not in df.columns:
+            continue
+
+        if operator in FILTER_COMPARISONS:
+            column = df[name]
+            if not pd.api.types.is_numeric_dtype(column):
+                column, value = column.astype(str), text
+            elif not isinstance(value, float):
+                continue
+
+            try:
+                df = df.loc[getattr(column, operator)(value)]
+            except TypeError:
+                continue
+
+        elif operator == 'contains':
+            df = df.loc[df[name].astype(str).str.contains(text, case=False, regex=False)]
+        elif operator == 'datestartswith':
+            df = df.loc[df[name].astype(str).str.startswith(text)]
+
+    return df
+
+
+def page_frame(df, page_current, page_size, sort_by, filter_query):
+    df = filter_frame(df, filter_query)
+
+    if sort_by:
+        df = df.sort_values([s['column_id'] for s in sort_by],
+                            ascending=[s['direction'] == 'asc' for s in sort_by])
+
+    page_count = max(1, -(-len(df) // page_size))
+    return df.iloc[page_current * page_size: (page_current + 1) * page_size], page_count
+
+
+def get_shots(stat_id, stat_type, season=CURRENT_SEASON):
+    """
+    every shot of the season for a player or team, read from the shot store a page at a time
+    """
     if stat_type == 'player':
-        return sql.load_data(shot_chart_query.format(stat_id, 'gp.[tid]'), SHOT_PLOT_COLUMNS)
+        query, params = player_shots_query, {'player_id': stat_id}
     elif stat_type == 'team':
-        return sql.load_data(shot_chart_query.format('gp.[pid]', stat_id), SHOT_PLOT_COLUMNS)
+        query, params = team_shots_query, {'team_id': stat_id}
+    else:
+        return None
 
+    pages = []
+    after_gid, after_evt = 0, 0
 
-def shot_map(data, stat_type):
-    if data is None:
-        return []
+    while True:
+        page = cache.run_query(query, page_size=SHOT_PAGE_SIZE, season=season, after_gid=after_gid,
+                               after_evt=after_evt, **params)
+        pages.append(page)
 
-    made_x = data[data['EType'] == 1]['LocationX']
-    made_y = data[data['EType'] == 1]['LocationY']
-    made_text = data[data['EType'] == 1]['Description']
+        if len(page) < SHOT_PAGE_SIZE:
+            break
 
-    missed_x = data[data['EType'] == 2]['LocationX']
-    missed_y = data[data['EType'] == 2]['LocationY']
-    missed_text = data[data['EType'] == 2]['Description']
+        after_gid, after_evt = page['GameID'].iloc[-1], page['Evt'].iloc[-1]
 
-    team_id = data['TeamID'].iloc[0]
-    roster = get_roster(team_id)
+    return pd.concat(pages, ignore_index=True)
 
-    if stat_type == 'player':
-        player_id = data['PlayerID'].iloc[0]
-        player = roster.loc[roster['player_id']
-                            == str(player_id), 'Player'].iloc[0]
 
-    title = player if stat_type == 'player' else teams.loc[teams['team_id'] == str(
-        team_id), 'name'].iloc[0]
-    url_id = player_id if stat_type == 'player' else team_id
-
-    shooting_stats = sql.load_data(
-        player_shooting_stats_query.format(team_id), SHOOTING_STATS_COLUMNS)
-    shooting_stats = shooting_stats[['Player', 'G', 'GS', 'FGM', 'FGA', 'FG%', 'FTM', 'FTA', 'FT%', 'PIP', 'PIPM',
-                                     'PIPA', 'PIP%', 'PTS', '3PM', '3PA', '3P%']]
-
-    data = [
-        go.Scatter(
-            x=made_x,
-            y=made_y,
-            text=made_text,
-            mode='markers',
-            name='Made',
-            opacity=0.7,
-            marker=dict(
-                size=5,
-                color='blue',
-                line=dict(
-                    width=1,
-                    color='rgb(0, 0, 0, 1)'
+def get_shooting_stats(team_id, season=CURRENT_SEASON):
+    return cache.run_query(player_season_shooting_query, team_id=team_id, season=season)
+
+
+def shot_points(data):
+    """
+    every shot as a WebGL marker, made and missed as separate traces
+    """
+    made = data['Made'].astype(bool)
+    traces = []
+
+    for name, shots, color in [('Made', data[made], 'blue'), ('Missed', data[~made], 'red')]:
+        traces.append(
+            go.Scattergl(
+                x=shots['LocationX'].values,
+                y=shots['LocationY'].values,
+                text=shots['Description'].values,
+                mode='markers',
+                name=name,
+                opacity=0.7,
+                marker=dict(
+                    size=5,
+                    color=color,
+                    line=dict(
+                        width=1,
+                        color='rgb(0, 0, 0, 1)'
+                    )
                 )
             )
-        ),
-        go.Scatter(
-            x=missed_x,
-            y=missed_y,
-            text=missed_text,
+        )
+
+    return traces
+
+
+def shot_bins(data):
+    """
+    shots aggregated into court bins, sized by attempts and coloured by fg%, so the figure grows with the
+    number of bins rather than the number of shots
+    """
+    x, y, attempts, fg_pct = bin_shots(data['LocationX'].values, data['LocationY'].values, data['Made'].values)
+
+    return [
+        go.Scattergl(
+            x=x,
+            y=y,
+            customdata=np.stack([attempts, fg_pct], axis=-1),
+            hovertemplate='%{customdata[0]} attempts<br>%{customdata[1]}% FG<extra></extra>',
             mode='markers',
-            name='Missed',
-            opacity=0.7,
+            name='FG%',
             marker=dict(
-                size=5,
-                color='red',
-                line=dict(
-                    width=1,
-                    color='rgb(0, 0, 0, 1)'
-                )
+                size=2 + np.sqrt(attempts / attempts.max()) * SHOT_BIN_MARKER_SIZE,
+                color=fg_pct,
+                colorscale='RdBu',
+                reversescale=True,
+                cmin=0,
+                cmax=100,
+                colorbar=dict(title='FG%'),
+                symbol='square'
             )
         )
     ]
 
-    layout = go.Layout(
-        title=f'Shooting Analysis: {title}',
-        showlegend=True,
-        xaxis=dict(
-            showgrid=False,
-            range=[-300, 300]
-        ),
-        yaxis=dict(
-            showgrid=False,
-            range=[-100, 500]
-        ),
-        height=600,
-        width=650,
-        shapes=court_plot()
-    )
 
+def shot_map(data, stat_type):
+    if data is None or len(data) == 0:
+        return []
+
+    team_id = data['TeamID'].iloc[0]
+
+    if stat_type == 'player':
+        player_id = data['PlayerID'].iloc[0]
+        player = get_roster_index().player_name(player_id)
+
+    title = player if stat_type == 'player' else teams.loc[teams['team_id'] == str(
+        team_id), 'name'].iloc[0]
+
+    data = shot_bins(data) if len(data) > SHOT_BIN_THRESHOLD else shot_points(data)
+
+    # only the traces and title are sent, the court layout is merged in the browser by render_shot_chart
     return html.Div(
         children=[
             html.H1(),
-            dcc.Graph(
-                id='shot_plot',
-                figure={
+            dcc.Store(
+                id='shot_chart_data',
+                data={
                     'data': data,
-                    'layout': layout
+                    'title': f'Shooting Analysis: {title}'
                 }
             ),
-            build_table(shooting_stats, 'Shot Summary', url_id)]
+            dcc.Graph(id='shot_chart'),
+            shot_table(team_id)]
     )
 
 
@@ -323,10 +439,7 @@ def division_image_header(conf, float, align):
 
 
 def team_box_plots(season):
-    query = team_compare_query.format(season)
-    teams = generate_teams_df()
-
-    team_stats = sql.load_data(query, TEAM_STATS_COLUMNS).sort_values(by='tid')
+    team_stats = cache.run_query(team_season_stats_query, season=season).sort_values(by='tid')
     team_stats = team_stats.drop(['season', 'games'], axis=1)
     metrics = team_stats.columns
     team_stats = team_stats.to_dict('records')
@@ -383,7 +496,7 @@ def team_box_plots(season):
             id='season_option',
             options=[{'label': i, 'value': i} for i in
                      ['2016-2017', '2017-2018', '2018-2019', '2019-2020']],
-            value='2019-2020',
+            value=CURRENT_SEASON,
             labelStyle={
                 'display': 'inline-block', 'padding': '5px'}
         ),
@@ -400,8 +513,7 @@ def team_box_plots(season):
 
 def player_cluster_scatter(season):
 
-    position_clusters = sql.load_data(position_clusters_query.format(
-        season), POSITION_CLUSTERS_COLUMNS).sort_values(by='tags')
+    position_clusters = cache.run_query(position_clusters_query, season=season).sort_values(by='tags')
 
     clusters = position_clusters.tags.unique().tolist()
     data = []
@@ -491,11 +603,19 @@ def get_player_img(player_id):
 teams = generate_teams_df()
 
 
+def get_roster_index():
+    """
+    built from the league roster once per rosters generation and shared by every callback until the next load
+    """
+    return cache.get_or_compute(('roster_index',), league_roster_query.tables,
+                                lambda: RosterIndex(sql.run_query(league_roster_query)))
+
+
 def get_roster(team_id=None):
     if team_id:
-        return sql.load_data(team_roster_query.format(team_id), CURRENT_ROSTER_COLUMNS)
+        return get_roster_index().team(team_id)
     else:
-        return sql.load_data(team_roster_query.format('[teamid]'), CURRENT_ROSTER_COLUMNS)
+        return get_roster_index().roster.copy()
 
 
 def default_layout():
@@ -544,23 +664,34 @@ def update_layout():
             html.Div(
                 id='shot_plot',
                 style={'padding': '10px'}
-            )
+            ),
+
+            dcc.Store(
+                id='court_layout',
+                data=COURT_LAYOUT
+            ),
+
+            # tab payloads already rendered in this page, keyed by tab_key
+            dcc.Store(id='tab_fetched'),
+            dcc.Store(id='tab_cache', data={}),
+            dcc.Store(id='tab_cache_keys', data=[])
         ])
 
 
 app.layout = update_layout()
 
 
-@app.callback(
-    Output('team_roster_container', 'children'),
-    [Input('team_url', 'pathname'), Input('div_tabs', 'value')]
-)
-def update_team_roster_table(pathname, value):
-    if pathname and value == 'ROSTER':
-        path = pathname.split('/')
-        path.pop(0)
-    else:
-        return html.P()
+@server.route('/metrics')
+def metrics():
+    return server.response_class(
+        json.dumps({'sql_pool': sql.stats(), 'query_cache': cache.stats(), 'prewarm': prewarmer.stats(),
+                    'import_seconds': IMPORT_SECONDS}),
+        mimetype='application/json')
+
+
+def roster_tab(pathname):
+    path = pathname.split('/')
+    path.pop(0)
 
     if path[0] == 'team':
         team_df = current_roster(path[1])
@@ -568,33 +699,145 @@ def update_team_roster_table(pathname, value):
         return build_table(team_df, 'Player Summary')
 
 
+def stats_tab(pathname):
+    # the same for every team, so built once per season rather than once per team page
+    return cache.get_or_compute(('team_box_plots', CURRENT_SEASON), TABS['STATS'][1],
+                                lambda: team_box_plots(CURRENT_SEASON))
+
+
+def shots_tab(pathname):
+    path = pathname.split('/')
+    path.pop(0)
+
+    shots = get_shots(path[1], path[0])
+
+    return shot_map(shots, path[0])
+
+
+# the builder of each tab and the tables its payload is read from
+TABS = {
+    'ROSTER': (roster_tab, league_roster_query.tables),
+    'STATS': (stats_tab, team_season_stats_query.tables + position_clusters_query.tables),
+    'SHOTS': (shots_tab, player_shots_query.tables + player_season_shooting_query.tables + league_roster_query.tables)
+}
+
+
+def tab_key(pathname, tab, season=CURRENT_SEASON):
+    """
+    the browser cache key of a tab's payload, it changes when ingestion bumps the generation of a table it reads
+    """
+    generations = cache.snapshot(TABS[tab][1])
+    return '|'.join([pathname, tab, season] + [str(g) for g in generations])
+
+
+def tab_payload(pathname, tab, key=None):
+    """
+    a tab's payload, built once per data generation and shared by every visitor through the query cache
+    """
+    build, tables = TABS[tab]
+    return cache.get_or_compute(('tab', key or tab_key(pathname, tab)), tables, lambda: build(pathname))
+
+
+def prewarm_pages():
+    return [(f'/team/{team_id}', tab) for team_id in TEAMS.keys() for tab in TABS.keys()]
+
+
+# a run is usually requested by ingestion right after it bumped the generations, so they are re-read first
+prewarmer = Prewarmer(tab_payload, prewarm_pages, before_run=cache.refresh_generations)
+
+
+@server.route('/prewarm', methods=['POST'])
+def prewarm():
+    prewarmer.start()
+    return server.response_class(json.dumps({'started': True}), status=202, mimetype='application/json')
+
+
 @app.callback(
-    Output('team_graph', 'children'),
-    [Input('div_tabs', 'value')]
+    Output('tab_fetched', 'data'),
+    [Input('team_url', 'pathname'), Input('div_tabs', 'value')],
+    [State('tab_cache_keys', 'data')]
+)
+def fetch_tab(pathname, value, cached_keys):
+    """
+    sends a tab's payload only when the browser doesn't hold it for the current data generations already,
+    otherwise just its key. the tab_cache clientside callbacks store the payload and render it into the tab
+    """
+    if not pathname or value not in TABS:
+        return {'key': None, 'tab': value}
+
+    key = tab_key(pathname, value)
+    if key in (cached_keys or []):
+        return {'key': key, 'tab': value}
+
+    return {'key': key, 'tab': value, 'payload': tab_payload(pathname, value, key)}
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='tabs', function_name='store_tab'),
+    Output('tab_cache', 'data'),
+    [Input('tab_fetched', 'data')],
+    [State('tab_cache', 'data')]
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='tabs', function_name='cached_keys'),
+    Output('tab_cache_keys', 'data'),
+    [Input('tab_cache', 'data')]
+)
+
+for tab, container in [('roster', 'team_roster_container'), ('stats', 'team_graph'), ('shots', 'shot_plot')]:
+    app.clientside_callback(
+        ClientsideFunction(namespace='tabs', function_name=f'render_{tab}'),
+        Output(container, 'children'),
+        [Input('tab_cache', 'data')],
+        [State('tab_fetched', 'data')]
+    )
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='shots', function_name='render_shot_chart'),
+    Output('shot_chart', 'figure'),
+    [Input('shot_chart_data', 'data')],
+    [State('court_layout', 'data')]
 )
-def update_stat_plot(value):
-    if value == 'STATS':
-        season = '2019-2020'
-        return team_box_plots(season)
-    else:
-        return html.P()
 
 
 @app.callback(
-    Output('shot_plot', 'children'),
-    [Input('team_url', 'pathname'), Input('div_tabs', 'value')]
+    [Output('shot_table', 'data'), Output('shot_table', 'page_count')],
+    [Input('shot_table', 'page_current'), Input('shot_table', 'page_size'), Input('shot_table', 'sort_by'),
+     Input('shot_table', 'filter_query')],
+    [State('shot_table_params', 'data')]
 )
-def update_shot_plot(pathname, value):
-    print(pathname)
-    if pathname and value == 'SHOTS':
-        path = pathname.split('/')
-        path.pop(0)
-    else:
-        return html.P()
+def update_shot_table(page_current, page_size, sort_by, filter_query, params):
+    if not params:
+        raise PreventUpdate
 
-    shots = get_shots(path[1], path[0])
+    shooting_stats = get_shooting_stats(params['team_id'], params['season'])[SHOT_TABLE_COLUMNS]
+    page, page_count = page_frame(shooting_stats, page_current or 0, page_size, sort_by, filter_query)
 
-    return shot_map(shots, path[0])
+    return page.to_dict('records'), page_count
+
+
+@server.before_first_request
+def start_background_work():
+    """
+    started by each worker on its first request rather than at import, so a --preload master never opens a
+    connection or starts a thread its forked workers would inherit
+    """
+    # warms every team page in the background, so the first visitors after a deploy don't pay for cold queries
+    if PREWARM_ON_START:
+        prewarmer.start()
+
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+if IMPORT_SECONDS > IMPORT_BUDGET:
+    logging.warning(f'app imported in {IMPORT_SECONDS:.2f}s, over the {IMPORT_BUDGET}s budget')
+else:
+    logging.info(f'app imported in {IMPORT_SECONDS:.2f}s')
+
+# everything built so far is shared copy-on-write with workers forked from a --preload master, moving it out of
+# the collector's generations stops gc from writing to, and so copying, those pages in every worker
+gc.freeze()
 
 
 if __name__ == '__main__':
@@ -51,3 +51,20 @@ EVENT_DEFINITIONS = {
     '13': 'End Period',
     '18': 'Instant Replay',
     '20': 'Stoppage: Out-of-Bounds'}
+
+SHOT_TABLE_HEADER_STYLE = {
+    'backgroundColor': '#0f6db5',
+    'textAlign': 'center',
+    'fontSize': '14px',
+    'padding': '10px',
+    'color': '#ffffff'}
+
+SHOT_TABLE_CELL_STYLE = {
+    'textAlign': 'center',
+    'fontSize': '12px',
+    'padding': '3px',
+    'font': '12px Open Sans, Arial, sans-serif'}
+
+SHOT_TABLE_STRIPE_STYLE = [{
+    'if': {'row_index': 'odd'},
+    'backgroundColor': '#f2f2f2'}]
@@ -0,0 +1,15 @@
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    shots: {
+        // merges the traces of a shot chart response into the court layout sent once with the page
+        render_shot_chart: function(chart, court) {
+            if (!chart) {
+                return {data: [], layout: court};
+            }
+
+            return {
+                data: chart.data,
+                layout: Object.assign({}, court, {title: chart.title})
+            };
+        }
+    }
+});
@@ -0,0 +1,45 @@
+// most tab payloads kept in the page, the oldest is dropped past this
+var TAB_CACHE_SIZE = 20;
+
+function render_tab(tab) {
+    // renders the cached payload of the fetched tab into this tab's container, and clears it for any other tab
+    return function(cache, fetched) {
+        if (!fetched || fetched.tab !== tab || !fetched.key || !cache) {
+            return null;
+        }
+
+        var payload = cache[fetched.key];
+        return payload === undefined ? null : payload;
+    };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    tabs: {
+        store_tab: function(fetched, cache) {
+            cache = cache || {};
+
+            if (!fetched || !fetched.key || !('payload' in fetched)) {
+                return cache;
+            }
+
+            var updated = Object.assign({}, cache);
+            delete updated[fetched.key];
+            updated[fetched.key] = fetched.payload;
+
+            var keys = Object.keys(updated);
+            for (var i = 0; i < keys.length - TAB_CACHE_SIZE; i++) {
+                delete updated[keys[i]];
+            }
+
+            return updated;
+        },
+
+        cached_keys: function(cache) {
+            return Object.keys(cache || {});
+        },
+
+        render_roster: render_tab('ROSTER'),
+        render_stats: render_tab('STATS'),
+        render_shots: render_tab('SHOTS')
+    }
+});
@@ -0,0 +1,189 @@
+import io
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+import shared_modules
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shared_modules import get_data, fetch_all, SqlConnection
+from response_cache import ResponseCache
+from schema_management import apply_indexes, drop_indexes, upsert_keys
+from sql_queries import player_shots_query
+
+
+def stub_server(delay=0.05, payload=None):
+    """
+    starts a local http server answering every GET with `payload` after `delay` seconds
+    returns the server and its base url
+    """
+    body = json.dumps(payload or {'g': {'gid': '0021900001', 'pd': []}}).encode()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://{0}:{1}'.format(*server.server_address)
+
+
+def fetch_benchmark(n_games=200, delay=0.05, workers=(1, 4, 8, 16), rate=None):
+    server, base_url = stub_server(delay)
+    urls = [f'{base_url}/{i:010d}_gamedetail.json' for i in range(n_games)]
+
+    # stub responses go to a throwaway cache rather than the real one
+    response_cache = shared_modules.response_cache
+    cache_dir = tempfile.TemporaryDirectory()
+    shared_modules.response_cache = ResponseCache(cache_dir.name)
+
+    try:
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for url in urls:
+                get_data(url)
+            sequential = time.perf_counter() - start
+
+        print(f'sequential get_data: {n_games / sequential:8.1f} req/s ({sequential:.2f}s)')
+
+        for max_workers in workers:
+            with redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                results = fetch_all(urls, max_workers=max_workers, rate=rate)
+                elapsed = time.perf_counter() - start
+
+            assert len(results) == n_games and all(r is not None for r in results)
+            print(f'fetch_all workers={max_workers:<3} rate={rate}: {n_games / elapsed:8.1f} req/s ({elapsed:.2f}s)')
+
+    finally:
+        server.shutdown()
+        shared_modules.response_cache = response_cache
+        cache_dir.cleanup()
+
+
+def synthetic_pbp(n_games=20, events_per_game=500, seed=42):
+    rnd = random.Random(seed)
+
+    for g in range(n_games):
+        gid = 21900001 + g
+        yield [{
+            'cl': '{0:02d}:{1:02d}'.format(rnd.randint(0, 11), rnd.randint(0, 59)),
+            'de': "[LAL] O'Neal Jump Shot: Made ({0} PTS)".format(rnd.randint(0, 40)),
+            'epid': '',
+            'etype': rnd.randint(1, 13),
+            'evt': e,
+            'gid': gid,
+            'hs': rnd.randint(0, 130),
+            'locX': rnd.randint(-250, 250),
+            'locY': rnd.randint(-50, 420),
+            'mid': 0,
+            'mtype': rnd.randint(0, 110),
+            'oftid': 1610612747,
+            'opid': '',
+            'opt1': rnd.randint(0, 3),
+            'opt2': 0,
+            'ord': e * 10000,
+            'period': 1 + e * 4 // events_per_game,
+            'pid': rnd.randint(201000, 1629000),
+            'tid': 1610612747,
+            'vs': rnd.randint(0, 130)
+        } for e in range(events_per_game)]
+
+
+def insert_benchmark(database='nba', n_games=20, events_per_game=500, table_name='benchmark_game_pbp'):
+    sql = SqlConnection(database)
+    drop_query = f"IF OBJECT_ID('[dbo].[{table_name}]') IS NOT NULL DROP TABLE [dbo].[{table_name}]"
+    n_rows = n_games * events_per_game
+
+    try:
+        for method in ('values', 'executemany'):
+            sql.cursor.execute(drop_query)
+
+            # the first pass inserts into an empty table, the second merges over the rows it wrote
+            for run in ('insert', 'merge'):
+                start = time.perf_counter()
+                for rows in synthetic_pbp(n_games, events_per_game):
+                    sql.insert_data(table_name, rows, ['gid', 'evt'], verbose=0, method=method)
+                elapsed = time.perf_counter() - start
+
+                print(f'{method:<12} {run:<7}: {n_rows / elapsed:10.1f} rows/s ({elapsed:.2f}s)')
+
+    finally:
+        sql.cursor.execute(drop_query)
+
+
+def best_time(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def index_benchmark(database='nba', repeats=5):
+    """
+    times a game_stats MERGE and a page of the shot store without and then with the indexes in schema_management
+    drops and rebuilds those indexes, so run it against a development database
+    """
+    sql = SqlConnection(database)
+
+    gid = sql.cursor.execute('SELECT TOP 1 [gid] FROM [dbo].[game_stats] ORDER BY [gid] DESC').fetchone()[0]
+    sql.cursor.execute('SELECT * FROM [dbo].[game_stats] WHERE [gid] = ?', gid)
+    columns = [c[0] for c in sql.cursor.description if c[0] not in ('game_stats_id', 'LastUpdated')]
+    rows = [{c: getattr(r, c) for c in columns} for r in sql.cursor.fetchall()]
+
+    season, pid = sql.cursor.execute('SELECT TOP 1 [season], [pid] FROM [dbo].[shots] '
+                                     'GROUP BY [season], [pid] ORDER BY COUNT(*) DESC').fetchone()
+
+    workloads = {
+        'game_stats merge': lambda: sql.insert_data('game_stats', rows, upsert_keys['game_stats'], verbose=0),
+        'shot chart query': lambda: sql.run_query(player_shots_query, page_size=5000, season=season, player_id=pid,
+                                                  after_gid=0, after_evt=0)
+    }
+
+    tables = ['games', 'game_stats', 'shots']
+    drop_indexes(sql, tables)
+    before = {name: best_time(fn, repeats) for name, fn in workloads.items()}
+
+    apply_indexes(sql, tables)
+    after = {name: best_time(fn, repeats) for name, fn in workloads.items()}
+
+    for name in workloads.keys():
+        print(f'{name:<18}: {before[name] * 1000:9.1f}ms -> {after[name] * 1000:9.1f}ms '
+              f'({before[name] / after[name]:.1f}x)')
+
+
+BENCHMARKS = {
+    'fetch': fetch_benchmark,
+    'insert': insert_benchmark,
+    'indexes': index_benchmark
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+
+    for name in names:
+        print(f'---------- {name} ----------')
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
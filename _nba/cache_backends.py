@@ -0,0 +1,317 @@
+import os
+import sys
+import glob
+import time
+import pickle
+import hashlib
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from response_cache import CACHE_DIR
+
+MEMORY_CACHE_SIZE = 512
+SHARED_CACHE_PATH = os.environ.get('NBA_SHARED_CACHE', os.path.join(CACHE_DIR, 'dashboard.sqlite'))
+SHARED_CACHE_MMAP_SIZE = 256 * 1024 ** 2
+SHARED_CACHE_BUSY_TIMEOUT = 5
+SHARED_CACHE_PURGE_INTERVAL = 500
+LEASE_TTL = 60
+LEASE_WAIT_INTERVAL = 0.05
+
+MISSING = object()
+
+
+def code_version(directory=os.path.dirname(os.path.abspath(__file__))):
+    """
+    a digest of the python version, requirements.txt and every module of the app, or NBA_CACHE_VERSION when set
+    the shared tier outlives restarts, so entries are keyed on it to never unpickle values written by other code
+    """
+    if os.environ.get('NBA_CACHE_VERSION'):
+        return os.environ['NBA_CACHE_VERSION']
+
+    digest = hashlib.sha256(sys.version.encode())
+    for path in sorted(glob.glob(os.path.join(directory, '*.py'))) + [os.path.join(directory, 'requirements.txt')]:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()[:16]
+
+
+class MemoryCache:
+    """
+    in-process tier, least recently used entries are evicted past `max_size`
+    every entry carries a tag, the data generations it was computed under, and a lookup with another tag is a miss
+    """
+    name = 'memory'
+
+    def __init__(self, max_size=MEMORY_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, tag):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[0] > time.monotonic() and entry[1] == tag:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+            self.misses += 1
+            return MISSING
+
+    def put(self, key, tag, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, tag, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, tag, compute, ttl):
+        value = self.get(key, tag)
+        if value is MISSING:
+            value = compute()
+            self.put(key, tag, value, ttl)
+
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class SqliteCache:
+    """
+    tier shared by every worker on the host, pickled values in a sqlite file in WAL mode so readers never block the
+    writer, with reads served from a memory mapped file. a lease row per key lets one worker compute a value while
+    the others wait for it. keys are prefixed with `version`, entries written by other code are left to expire
+    """
+    name = 'shared'
+
+    def __init__(self, path=SHARED_CACHE_PATH, mmap_size=SHARED_CACHE_MMAP_SIZE, version=None):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.version = version or code_version()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def connection(self):
+        # one connection per thread, and never one opened by the process this one was forked from
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=SHARED_CACHE_BUSY_TIMEOUT, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={self.mmap_size}')
+        conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                     '(key TEXT PRIMARY KEY, tag TEXT, expires REAL, value BLOB)')
+        conn.execute('CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def versioned(self, key):
+        return f'{self.version}:{key}'
+
+    def get(self, key, tag):
+        try:
+            row = self.connection().execute(
+                'SELECT value FROM entries WHERE key = ? AND tag = ? AND expires > ?',
+                (self.versioned(key), tag, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f'Shared cache read failed: {e}')
+            self.count('errors')
+            row = None
+
+        if row is None:
+            self.count('misses')
+            return MISSING
+
+        # anything can be raised unpickling, eg. a class that moved or changed, the entry is then dropped as a miss
+        try:
+            value = pickle.loads(row[0])
+        except Exception as e:
+            logging.warning(f'Shared cache entry unreadable for {key}: {e}')
+            self.count('errors')
+            self.count('misses')
+            self.delete(key)
+            return MISSING
+
+        self.count('hits')
+        return value
+
+    def delete(self, key):
+        try:
+            self.connection().execute('DELETE FROM entries WHERE key = ?', (self.versioned(key),))
+        except sqlite3.Error as e:
+            logging.warning(f'Shared cache delete failed for {key}: {e}')
+
+    def put(self, key, tag, value, ttl):
+        try:
+            self.connection().execute(
+                'INSERT OR REPLACE INTO entries (key, tag, expires, value) VALUES (?, ?, ?, ?)',
+                (self.versioned(key), tag, time.time() + ttl,
+                 sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+        except (sqlite3.Error, pickle.PicklingError, TypeError, AttributeError) as e:
+            logging.warning(f'Shared cache write failed for {key}: {e}')
+            self.count('errors')
+            return
+
+        # counted and checked under the lock so a single put per interval purges, the purge itself runs outside it
+        with self.lock:
+            self.puts += 1
+            purge = self.puts % SHARED_CACHE_PURGE_INTERVAL == 0
+
+        if purge:
+            self.purge()
+
+    def purge(self):
+        now = time.time()
+        try:
+            conn = self.connection()
+            conn.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+            conn.execute('DELETE FROM leases WHERE expires <= ?', (now,))
+        except sqlite3.Error as e:
+            logging.warning(f'Shared cache purge failed: {e}')
+            self.count('errors')
+
+    def owner(self):
+        return f'{os.getpid()}:{threading.get_ident()}'
+
+    def acquire(self, key, ttl=LEASE_TTL):
+        """
+        takes the lease on `key` unless another worker holds an unexpired one, a lease left by a dead worker
+        expires after `ttl` seconds
+        """
+        conn = self.connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM leases WHERE key = ? AND expires <= ?', (self.versioned(key), time.time()))
+            acquired = conn.execute('INSERT OR IGNORE INTO leases (key, owner, expires) VALUES (?, ?, ?)',
+                                    (self.versioned(key), self.owner(), time.time() + ttl)).rowcount == 1
+            conn.execute('COMMIT')
+            return acquired
+
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+
+            logging.warning(f'Shared cache lease failed for {key}: {e}')
+            self.count('errors')
+            return True
+
+    def release(self, key):
+        try:
+            self.connection().execute('DELETE FROM leases WHERE key = ? AND owner = ?',
+                                      (self.versioned(key), self.owner()))
+        except sqlite3.Error as e:
+            logging.warning(f'Shared cache lease release failed for {key}: {e}')
+
+    def clear(self):
+        try:
+            conn = self.connection()
+            conn.execute('DELETE FROM entries')
+            conn.execute('DELETE FROM leases')
+        except sqlite3.Error as e:
+            logging.warning(f'Shared cache clear failed: {e}')
+            self.count('errors')
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'puts': self.puts, 'errors': self.errors,
+                    'version': self.version}
+
+
+class TieredCache:
+    """
+    the memory tier in front of the shared one. on a miss in both, only the worker holding the key's lease computes
+    the value, the others poll the shared tier until it's written or the lease is released or expires
+    """
+    def __init__(self, memory=None, shared=None, lease_ttl=LEASE_TTL, wait_interval=LEASE_WAIT_INTERVAL):
+        self.memory = memory or MemoryCache()
+        self.shared = shared or SqliteCache()
+        self.lease_ttl = lease_ttl
+        self.wait_interval = wait_interval
+        self.lock = threading.Lock()
+        self.computes = 0
+        self.waits = 0
+
+    def get_or_compute(self, key, tag, compute, ttl):
+        value = self.memory.get(key, tag)
+        if value is not MISSING:
+            return value
+
+        waited = False
+        while True:
+            value = self.shared.get(key, tag)
+            if value is not MISSING:
+                self.memory.put(key, tag, value, ttl)
+                return value
+
+            if self.shared.acquire(key, self.lease_ttl):
+                break
+
+            if not waited:
+                waited = True
+                with self.lock:
+                    self.waits += 1
+
+            time.sleep(self.wait_interval)
+
+        try:
+            with self.lock:
+                self.computes += 1
+
+            value = compute()
+            self.shared.put(key, tag, value, ttl)
+            self.memory.put(key, tag, value, ttl)
+            return value
+
+        finally:
+            self.shared.release(key)
+
+    def clear(self):
+        self.memory.clear()
+        self.shared.clear()
+
+    def stats(self):
+        with self.lock:
+            counts = {'computes': self.computes, 'waits': self.waits}
+
+        return {self.memory.name: self.memory.stats(), self.shared.name: self.shared.stats(), **counts}
+
+
+CACHE_BACKENDS = {
+    'memory': MemoryCache,
+    'tiered': TieredCache
+}
+
+
+def create_backend(name=None):
+    name = name or os.environ.get('NBA_CACHE_BACKEND', 'tiered')
+    return CACHE_BACKENDS[name]()
@@ -1,3 +1,11 @@
+import numpy as np
+
+# court coordinates are in tenths of a foot with the hoop at the origin, the same system as game_pbp locX/locY
+COURT_X_RANGE = (-250, 250)
+COURT_Y_RANGE = (-47.5, 422.5)
+COURT_BIN_SIZE = 15
+
+
 def court_plot():
     # ---------- OUTER LINES ----------
     court_shapes = []
@@ -205,3 +213,48 @@ def court_plot():
     court_shapes.append(res_area_shape)
 
     return court_shapes
+
+
+def bin_shots(x, y, made, bin_size=COURT_BIN_SIZE):
+    """
+    counts attempts and makes on a square grid over the half court, shots beyond it fall in the edge bins
+    returns the centre of every bin with at least one attempt, its attempts and its fg%
+    """
+    x_edges = np.arange(COURT_X_RANGE[0], COURT_X_RANGE[1] + bin_size, bin_size)
+    y_edges = np.arange(COURT_Y_RANGE[0], COURT_Y_RANGE[1] + bin_size, bin_size)
+
+    x = np.clip(np.asarray(x, dtype=float), x_edges[0], x_edges[-1] - 1e-6)
+    y = np.clip(np.asarray(y, dtype=float), y_edges[0], y_edges[-1] - 1e-6)
+    made = np.asarray(made, dtype=bool)
+
+    attempts, _, _ = np.histogram2d(x, y, bins=[x_edges, y_edges])
+    makes, _, _ = np.histogram2d(x[made], y[made], bins=[x_edges, y_edges])
+
+    ix, iy = np.nonzero(attempts)
+    attempts = attempts[ix, iy]
+
+    return x_edges[ix] + bin_size / 2, y_edges[iy] + bin_size / 2, attempts.astype(int), \
+        np.round(makes[ix, iy] / attempts * 100, 1)
+
+
+def numeric_shape(shape):
+    return {k: float(v) if k in ('x0', 'y0', 'x1', 'y1') else v for k, v in shape.items()}
+
+
+# built once at import and shipped to the browser once per page load, shot chart callbacks only send traces
+COURT_SHAPES = [numeric_shape(shape) for shape in court_plot()]
+
+COURT_LAYOUT = dict(
+    showlegend=True,
+    xaxis=dict(
+        showgrid=False,
+        range=[-300, 300]
+    ),
+    yaxis=dict(
+        showgrid=False,
+        range=[-100, 500]
+    ),
+    height=600,
+    width=650,
+    shapes=COURT_SHAPES
+)
@@ -0,0 +1,91 @@
+import logging
+from shared_modules import SqlConnection, create_logger
+from pipeline import batched
+from schema_management import apply_indexes
+from query_cache import bump_generations
+from sql_queries import TEAM_STAT_TOTALS, PLAYER_SHOOTING_TOTALS, refresh_team_stats_query, \
+    refresh_player_shooting_query, refresh_shots_query
+
+REFRESH_BATCH_SIZE = 500
+
+# aggregate tables derived from the ingested ones, keyed the same way the refresh MERGEs join on
+DERIVED_TABLES = {
+    'team_game_stats': dict(
+        [('gid', '[bigint] NOT NULL'), ('tid', '[bigint] NOT NULL'), ('season', '[varchar](10) NULL'),
+         ('players', '[int] NULL')] + [(c, '[bigint] NULL') for c in TEAM_STAT_TOTALS]),
+    'team_season_stats': dict(
+        [('tid', '[bigint] NOT NULL'), ('season', '[varchar](10) NOT NULL'), ('games', '[int] NULL')] +
+        [(c, '[bigint] NULL') for c in TEAM_STAT_TOTALS]),
+    'player_season_shooting': dict(
+        [('season', '[varchar](10) NOT NULL'), ('tid', '[bigint] NOT NULL'), ('pid', '[bigint] NOT NULL'),
+         ('player', '[nvarchar](61) NULL'), ('appearances', '[int] NULL'), ('starts', '[int] NULL')] +
+        [(c, '[bigint] NULL') for c in PLAYER_SHOOTING_TOTALS]),
+    'shots': {
+        'season': '[varchar](10) NOT NULL', 'gid': '[bigint] NOT NULL', 'evt': '[bigint] NOT NULL',
+        'pid': '[bigint] NOT NULL', 'tid': '[bigint] NOT NULL', 'opp_tid': '[bigint] NULL', 'period': '[tinyint] NULL',
+        'cl': '[nvarchar](10) NULL', 'de': '[nvarchar](255) NULL', 'etype': '[tinyint] NOT NULL',
+        'made': '[bit] NOT NULL', 'locX': '[smallint] NULL', 'locY': '[smallint] NULL', 'distance': '[real] NULL'
+    }
+}
+
+# the derived tables refreshed after writes to each ingested table, in order
+REFRESH_QUERIES = {
+    'game_stats': [refresh_team_stats_query, refresh_player_shooting_query],
+    'game_pbp': [refresh_shots_query]
+}
+
+
+def create_derived_tables(sql):
+    """
+    creates any missing derived table along with its indexes, which is what places shots on the season partitions
+    """
+    for table_name, table_columns in DERIVED_TABLES.items():
+        if not sql.check_if_table_exists(table_name, table_columns):
+            apply_indexes(sql, [table_name])
+
+
+def refresh(sql, query, game_ids):
+    for batch in batched(game_ids, REFRESH_BATCH_SIZE):
+        sql.execute(query.sql, query.bind(game_ids=','.join(batch)))
+
+
+def refresh_derived_tables(sql, written):
+    """
+    re-aggregates the derived tables for the rows touched by the games written, given as {table_name: game ids}
+    so a load only rewrites what it changed. game_stats writes refresh team_game_stats for those games, then
+    team_season_stats for each of their teams and seasons and player_season_shooting for each season, team and
+    player appearing in them. game_pbp writes refresh the shots of those games
+    """
+    written = {t: sorted({str(int(g)) for g in game_ids}) for t, game_ids in written.items() if game_ids}
+    if not written:
+        return
+
+    create_derived_tables(sql)
+
+    for table_name, game_ids in written.items():
+        for query in REFRESH_QUERIES.get(table_name, []):
+            refresh(sql, query, game_ids)
+
+        logging.info(f'Derived tables refreshed for {len(game_ids)} games written to {table_name}')
+
+    bump_generations(sql, list(written) + list(DERIVED_TABLES))
+
+
+def rebuild_derived_tables(sql):
+    written = {}
+    for table_name in REFRESH_QUERIES.keys():
+        query = f'SELECT DISTINCT [gid] FROM [dbo].[{table_name}]'
+        written[table_name] = [r[0] for r in sql.cursor.execute(query).fetchall()]
+
+    refresh_derived_tables(sql, written)
+
+
+def main():
+    create_logger(__file__)
+
+    sql = SqlConnection('nba')
+    rebuild_derived_tables(sql)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 import time
-import requests
 import logging
-from shared_modules import SqlConnection, create_logger, get_data
+from shared_modules import SqlConnection, create_logger, get_data, http_get, request_stats
 from nba_settings import draft_combine_1, draft_combine_2, headers, referer_default
 
 """
@@ -67,7 +66,7 @@ def combine_results(activity_type, sql, headers):
 
         url = f'{draft_combine_2}{activity_type}'
 
-        drill_request = requests.request('GET', url, headers=headers, params=params)
+        drill_request = http_get(url, headers=headers, params=params)
         draft_data.append(drill_request.json())
 
         print(drill_request.status_code, season, activity_type)
@@ -89,6 +88,8 @@ def main():
     for activity in activity_types:
         combine_results(activity, sql, headers)
 
+    request_stats.log()
+
 
 if __name__ == '__main__':
     main()
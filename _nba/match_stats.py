@@ -1,19 +1,59 @@
 import os
+import sys
+import io
+import json
 import logging
 import time
+from collections import defaultdict
 from datetime import datetime, timedelta
-from shared_modules import create_logger, get_data, SqlConnection
+from shared_modules import create_logger, get_data, get_content, fetch_iter, request_stats, SqlConnection, FETCH_WORKERS, FETCH_RATE
 from nba_settings import current_season_1, current_season_2, current_season_3
 from nba_modules import current_nba_season
+from response_cache import set_replay_mode
+from pipeline import run_pipeline, batched
+from schema_management import upsert_keys
+from derived_tables import refresh_derived_tables
+from query_cache import bump_generations
+from prewarm import request_prewarm
+from sql_queries import add_games_status_query, ingested_games_query
 
-upsert_keys = {
-    'games': ['game_id'],
-    'game_stats': ['gid', 'tid'],
-    'game_pbp': ['gid', 'pid', 'tid']
-}
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+    PARSE_ERRORS = (ValueError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    PARSE_ERRORS = (ValueError,)
 
+FINAL_STATUS = '3'
+PBP_BATCH_SIZE = 1000
+WATERMARK_COLUMNS = ['away_score', 'home_score', 'status']
 
-def get_schedule(url, logger, sql, offset=14):
+
+def watermark_value(value):
+    return '' if value is None else str(value)
+
+
+def ingested_games(sql, seasons):
+    sql.load_data(add_games_status_query)
+    sql.invalidate_schema()
+
+    watermarks = {}
+    for season in seasons:
+        ingested = sql.run_query(ingested_games_query, season=season)
+
+        for game in ingested.to_dict('records'):
+            watermarks[str(game['game_id'])] = tuple(watermark_value(game[c]) for c in WATERMARK_COLUMNS)
+
+    return watermarks
+
+
+def changed_games(games, watermarks):
+    return [game for game in games
+            if watermarks.get(str(game['game_id'])) != tuple(watermark_value(game[c]) for c in WATERMARK_COLUMNS)]
+
+
+def get_schedule(url, logger, sql, offset=14, incremental=True):
     game_rqst = get_data(url)
 
     now = datetime.strptime(time.strftime('%Y-%m-%d'), '%Y-%m-%d')
@@ -22,6 +62,7 @@ def get_schedule(url, logger, sql, offset=14):
     logger.info(f'Fetching games between: {date_offset_str} - {now}')
 
     games = []
+    final_games = set()
     for i in game_rqst['lscd']:
         for j in i['mscd']['g']:
             game_date = datetime.strptime(j['gdte'], '%Y-%m-%d')
@@ -36,103 +77,265 @@ def get_schedule(url, logger, sql, offset=14):
                     'away_score': j['v']['s'],
                     'home_team_id': j['h']['tid'],
                     'home_score': j['h']['s'],
-                    'season': current_nba_season(game_date)
+                    'season': current_nba_season(game_date),
+                    'status': str(j['st'])
                 })
 
+                if str(j['st']) == FINAL_STATUS:
+                    final_games.add(j['gid'])
+
+    if incremental and games:
+        scheduled = len(games)
+        games = changed_games(games, ingested_games(sql, {i['season'] for i in games}))
+        logger.info(f'{len(games)} of {scheduled} games are new or changed since the last sync')
+
     if len(games) == 0:
         logging.info('No games to import')
         print(f'0 new games to import between; {date_offset_str} - {now}')
-        raise SystemExit(0)
+        return [], set()
 
-    sql.insert_data('games', games, upsert_keys['games'])
-    return [i['game_id'] for i in games]
+    # the rows are only written once the game's stats are, as they hold the watermark of what was loaded
+    return games, final_games & {i['game_id'] for i in games}
 
 
-def get_game_stats(url, url_prop, list_of_games):
-    game_stats = []
-    for i in list_of_games:
+def iter_game_stats(url, url_prop, list_of_games, final_games=(), max_workers=FETCH_WORKERS, rate=FETCH_RATE,
+                    raw=False):
+    final_urls = {'{0}{1}_{2}.json'.format(url, i, url_prop) for i in final_games}
+    fetch = get_content if raw else get_data
+
+    def fetch_game(stats_url):
         try:
-            stats_url = '{0}{1}_{2}.json'.format(url, i, url_prop)
-            stats_req = get_data(base_url=stats_url)
-            game_stats.append(stats_req)
+            return fetch(base_url=stats_url, immutable=stats_url in final_urls)
 
         except ValueError as e:
-            logging.error(i, e)
+            logging.error(f'{stats_url}: {e}')
 
-    return game_stats
+    stats_urls = ['{0}{1}_{2}.json'.format(url, i, url_prop) for i in list_of_games]
 
+    return fetch_iter(stats_urls, fetch=fetch_game, max_workers=max_workers, rate=rate)
 
-def game_detail_stats(game_json, sql):
-    for a in game_json:
-        stats = []
-        if a is None:
-            continue
-        for b in [a['g']]:
-            for prop in ['vls', 'hls']:
-                if 'pstsg' not in b[prop] or 'tstsg' not in b[prop]:
-                    logging.warning(f"'pstsg'/'tstsg' not in game_id: {b['gid']}")
-                    continue
-
-                for c in b[prop]['pstsg']:
-                    c['gid'] = b['gid']
-                    c['mid'] = b['mid']
-                    c['tid'] = b[prop]['tid']
-                    c['ta'] = b[prop]['ta']
-                    stats.append(c)
-        try:
-            sql.insert_data('game_stats', stats, upsert_keys['game_stats'])
-        except Exception as e:
-            print(e)
+
+def parse_game_detail(game):
+    stats = []
+    for b in [game['g']]:
+        for prop in ['vls', 'hls']:
+            if 'pstsg' not in b[prop] or 'tstsg' not in b[prop]:
+                logging.warning(f"'pstsg'/'tstsg' not in game_id: {b['gid']}")
+                continue
+
+            for c in b[prop]['pstsg']:
+                c['gid'] = b['gid']
+                c['mid'] = b['mid']
+                c['tid'] = b[prop]['tid']
+                c['ta'] = b[prop]['ta']
+                stats.append(c)
+
+    return stats
 
 
-def game_pbp_stats(game_json, sql):
-    for i in game_json:
-        play_by_play = []
-        if i is None:
+def parse_game_pbp(game):
+    play_by_play = []
+    for j in game['g']['pd']:
+        if 'pla' not in j:
+            logging.warning(f"'pla' not in game_id: {game['g']['gid']}")
             continue
-        for j in i['g']['pd']:
-            for k in j['pla']:
-                if 'pla' not in j:
-                    logging.warning(f"'pla' not in game_id: {i['g']['gid']}")
-                    continue
 
-                k['period'] = j['p']
-                k['gid'] = i['g']['gid']
-                k['mid'] = i['g']['mid']
-                play_by_play.append(k)
+        for k in j['pla']:
+            k['period'] = j['p']
+            k['gid'] = game['g']['gid']
+            k['mid'] = game['g']['mid']
+            play_by_play.append(k)
+
+    return play_by_play
+
+
+def pbp_row(row, period, game):
+    row['period'] = period
+    row['gid'] = game.get('gid')
+    row['mid'] = game.get('mid')
+    return row
+
+
+def iter_pbp_events(content):
+    """
+    streams the events of a raw full_pbp document as flattened g.pd[].pla[] rows, without building the whole document
+    falls back to json.loads when ijson isn't installed
+    """
+    if ijson is None:
+        yield from parse_game_pbp(json.loads(content))
+        return
+
+    game = {}
+    periods = {}
+    period_index = -1
+    builder = None
+    out_of_order = []
+
+    for prefix, event, value in ijson.parse(io.BytesIO(content)):
+        if builder is not None:
+            builder.event(event, value)
+
+            if prefix == 'g.pd.item.pla.item' and event == 'end_map':
+                row, builder = builder.value, None
+
+                if period_index in periods and 'gid' in game and 'mid' in game:
+                    yield pbp_row(row, periods[period_index], game)
+                else:
+                    out_of_order.append((period_index, row))
+
+        elif prefix == 'g.pd.item.pla.item' and event == 'start_map':
+            builder = ObjectBuilder()
+            builder.event(event, value)
+
+        elif prefix == 'g.pd.item' and event == 'start_map':
+            period_index += 1
 
-        try:
-            sql.insert_data('game_pbp', play_by_play, upsert_keys['game_pbp'])
-        except Exception as e:
-            print(e)
+        elif prefix == 'g.pd.item.p':
+            periods[period_index] = value
+
+        elif prefix in ('g.gid', 'g.mid'):
+            game[prefix[2:]] = value
+
+    # only when gid/mid/p come after the events they describe
+    for index, row in out_of_order:
+        yield pbp_row(row, periods.get(index), game)
+
+
+def stream_game_pbp(game_id, content, batch_size=PBP_BATCH_SIZE):
+    """
+    yields the game's events in batches, followed by a marker once all of them were parsed
+    """
+    try:
+        for batch in batched(iter_pbp_events(content), batch_size):
+            yield 'game_pbp', game_id, batch
+
+    except PARSE_ERRORS as e:
+        logging.error(f'Unable to parse full_pbp for {game_id}: {e}')
+        yield 'failed', game_id, None
+        return
+
+    yield 'game_pbp_done', game_id, None
 
 
-def update_stats(season, logger):
+def write_stats(sql, table_name, rows):
+    """
+    returns whether the rows were written
+    """
+    if not rows:
+        return True
+
+    try:
+        sql.insert_data(table_name, rows, upsert_keys[table_name])
+        return True
+    except Exception as e:
+        print(e)
+        logging.error(f'Unable to write {table_name}: {e}')
+        return False
+
+
+def load_game_stats(sql, season, games, final_games):
+    """
+    fetches, parses and writes box scores then play-by-play as a pipeline, so fetching carries on during writes
+    and only a bounded number of games are held in memory at once. play-by-play is streamed from the raw
+    response and written in batches of PBP_BATCH_SIZE events.
+    a game's schedule row, the watermark incremental loads compare against, is written once its box score and all
+    of its play-by-play are, so a game that failed to fetch, parse or write is loaded again by the next sync.
+    the derived tables are refreshed for the loaded games once everything is written
+    """
+    schedule = {i['game_id']: i for i in games}
+    game_ids = list(schedule.keys())
+    written = defaultdict(set)
+    details = set()
+    failed = set()
+    completed = []
+
+    def fetch():
+        detail_url = current_season_2.format(season)
+        for game_id, game in zip(game_ids, iter_game_stats(detail_url, 'gamedetail', game_ids, final_games)):
+            yield 'gamedetail', game_id, game
+
+        pbp_url = current_season_3.format(season)
+        for game_id, content in zip(game_ids, iter_game_stats(pbp_url, 'full_pbp', game_ids, final_games, raw=True)):
+            yield 'full_pbp', game_id, content
+
+    def parse(item):
+        url_prop, game_id, game = item
+
+        if game is None:
+            return 'failed', game_id, None
+
+        if url_prop == 'full_pbp':
+            return stream_game_pbp(game_id, game)
+
+        return 'game_stats', game_id, parse_game_detail(game)
+
+    def write(item):
+        table_name, game_id, rows = item
+
+        if table_name == 'failed':
+            failed.add(game_id)
+
+        elif table_name == 'game_pbp_done':
+            # every box score is written before the first play-by-play
+            if game_id in details and game_id not in failed:
+                sql.insert_data('games', [schedule[game_id]], upsert_keys['games'], verbose=0)
+                completed.append(game_id)
+
+        elif write_stats(sql, table_name, rows):
+            written[table_name].update(row['gid'] for row in rows)
+
+            if table_name == 'game_stats':
+                details.add(game_id)
+
+        else:
+            failed.add(game_id)
+
+    try:
+        run_pipeline(fetch(), [parse], write)
+
+    finally:
+        if len(completed) < len(game_ids):
+            logging.warning(f'{len(game_ids) - len(completed)} of {len(game_ids)} games were not fully loaded, '
+                            f'they will be fetched again by the next sync')
+
+        if completed:
+            bump_generations(sql, ['games'])
+
+        refresh_derived_tables(sql, written)
+
+
+def update_stats(season, logger, incremental=True):
     logger.info(f'Season: {season}')
 
     sql = SqlConnection('nba')
 
-    games = get_schedule(current_season_1.format(season), logger, sql)
-
-    game_detail_json = get_game_stats(current_season_2.format(season), 'gamedetail', games)
-    game_detail_stats(game_detail_json, sql)
+    games, final_games = get_schedule(current_season_1.format(season), logger, sql, incremental=incremental)
+    if not games:
+        return
 
-    game_pbp_json = get_game_stats(current_season_3.format(season), 'full_pbp', games)
-    game_pbp_stats(game_pbp_json, sql)
+    load_game_stats(sql, season, games, final_games)
 
+    request_stats.log()
     logging.info('Task completed')
 
 
-def bulk_load():
+def bulk_load(incremental=True):
     for season in range(2016, 2020):
-        update_stats(season=season, logger=logging)
+        update_stats(season=season, logger=logging, incremental=incremental)
+
+    request_prewarm()
 
 
 def main():
     create_logger(__file__)
     os.environ['TZ'] = 'US/Eastern'
 
-    bulk_load()
+    # rebuild the tables from the response cache only, without any network calls
+    if '--replay' in sys.argv:
+        set_replay_mode(True)
+
+    # re-fetch every game instead of only new games and games whose status or score changed
+    bulk_load(incremental='--full' not in sys.argv)
     # update_stats(season='2019', logger=logging)
 
 
@@ -0,0 +1,111 @@
+import types
+import queue
+import logging
+import threading
+from itertools import islice
+
+PIPELINE_QUEUE_SIZE = 16
+
+_DONE = object()
+
+
+def run_pipeline(source, stages, sink, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+    streams items from `source` through each function in `stages` into `sink`
+    the source and every stage run on their own thread, connected by bounded queues, so a slow stage blocks the
+    stages before it instead of letting items pile up in memory. a stage returning None drops the item and a stage
+    returning a generator emits every item it yields.
+    the sink runs on the calling thread, which keeps writes on the thread owning the sql connection.
+    the first exception raised anywhere stops every stage and is re-raised here.
+    """
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return _DONE
+
+    def fail(e):
+        logging.exception(e)
+        errors.append(e)
+        stop.set()
+
+    def produce():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+        except Exception as e:
+            fail(e)
+        finally:
+            put(queues[0], _DONE)
+
+    def transform(stage, q_in, q_out):
+        try:
+            while True:
+                item = get(q_in)
+                if item is _DONE:
+                    break
+
+                result = stage(item)
+                results = result if isinstance(result, types.GeneratorType) else [result]
+
+                for result in results:
+                    if result is not None and not put(q_out, result):
+                        return
+        except Exception as e:
+            fail(e)
+        finally:
+            put(q_out, _DONE)
+
+    threads = [threading.Thread(target=produce, name='pipeline-source', daemon=True)]
+    for i, stage in enumerate(stages):
+        threads.append(threading.Thread(target=transform, args=(stage, queues[i], queues[i + 1]),
+                                        name=f'pipeline-{getattr(stage, "__name__", i)}', daemon=True))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = get(queues[-1])
+            if item is _DONE:
+                break
+
+            sink(item)
+    except Exception as e:
+        fail(e)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+
+        yield batch
@@ -1,4 +1,5 @@
 from shared_modules import SqlConnection
+from query_cache import bump_generations
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -246,6 +247,7 @@ def main():
                     TRUNCATE TABLE [position_clusters]''')
 
     sql.insert_data('position_clusters', df.to_dict('records'))
+    bump_generations(sql, ['position_clusters'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+import os
+import time
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+PREWARM_WORKERS = 4
+PREWARM_URL = os.environ.get('NBA_PREWARM_URL')
+PREWARM_TIMEOUT = 10
+
+
+class Prewarmer:
+    """
+    builds a list of pages ahead of the first visitor, so their queries and payloads are served from the app cache
+    `build(pathname, tab)` is the app's cached page builder. runs at most once at a time, a request while a run is
+    in progress is dropped as that run will pick up the same data. `before_run` is called first, eg. to pick up the
+    data generations ingestion just bumped
+    """
+    def __init__(self, build, pages, max_workers=PREWARM_WORKERS, before_run=None):
+        self.build = build
+        self.pages = pages
+        self.max_workers = max_workers
+        self.before_run = before_run
+        self.lock = threading.Lock()
+        self.running = False
+        self.report = None
+
+    def build_page(self, page):
+        pathname, tab = page
+        start = time.perf_counter()
+
+        try:
+            self.build(pathname, tab)
+            error = None
+        except Exception as e:
+            logging.exception(e)
+            error = str(e)
+
+        return {'pathname': pathname, 'tab': tab, 'seconds': round(time.perf_counter() - start, 3), 'error': error}
+
+    def run(self):
+        with self.lock:
+            if self.running:
+                logging.info('Prewarm already running')
+                return None
+
+            self.running = True
+
+        try:
+            start = time.perf_counter()
+            if self.before_run is not None:
+                self.before_run()
+
+            pages = self.pages() if callable(self.pages) else self.pages
+
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='prewarm') as executor:
+                results = list(executor.map(self.build_page, pages))
+
+            self.report = {
+                'pages': len(results),
+                'errors': sum(1 for r in results if r['error']),
+                'seconds': round(time.perf_counter() - start, 3),
+                'slowest': sorted(results, key=lambda r: r['seconds'], reverse=True)[:5],
+                'results': results
+            }
+
+            for result in results:
+                logging.info('Prewarmed {pathname} {tab}: {seconds}s'.format(**result))
+
+            logging.info(f"Prewarm completed: {self.report['pages']} pages in {self.report['seconds']}s, "
+                         f"{self.report['errors']} errors")
+
+            return self.report
+
+        finally:
+            with self.lock:
+                self.running = False
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='prewarm', daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        if self.report is None:
+            return {'running': self.running}
+
+        return {'running': self.running, **{k: v for k, v in self.report.items() if k != 'results'}}
+
+
+def request_prewarm(url=PREWARM_URL):
+    """
+    asks the running app to prewarm, called by ingestion once it has written. does nothing when no url is configured
+    """
+    if not url:
+        return
+
+    try:
+        requests.post(url, timeout=PREWARM_TIMEOUT)
+        logging.info(f'Prewarm requested: {url}')
+    except requests.RequestException as e:
+        logging.warning(f'Unable to request prewarm: {e}')
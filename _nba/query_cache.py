@@ -0,0 +1,92 @@
+import time
+import logging
+import threading
+from cache_backends import MemoryCache
+from sql_queries import data_generations_query, bump_generation_query
+
+QUERY_CACHE_SIZE = 512
+QUERY_CACHE_TTL = 60 * 60
+GENERATION_CHECK_INTERVAL = 10
+
+
+def bump_generations(sql, tables):
+    """
+    marks the tables as changed, so cached results read from them are recomputed on their next use
+    """
+    for table_name in sorted({t.lower() for t in tables}):
+        sql.execute(bump_generation_query.sql, bump_generation_query.bind(table_name=table_name))
+
+    logging.info(f'Data generation bumped: {sorted(tables)}')
+
+
+class QueryCache:
+    """
+    results of registered queries kept in a cache backend, keyed by query name and bound parameters
+    an entry is served until its ttl runs out or ingestion bumps the generation of one of the tables the query reads.
+    generations are re-read at most every `check_interval` seconds, which bounds how long a page can lag behind a
+    load. the default backend is in-process, see cache_backends for one shared by every worker on the host
+    """
+    def __init__(self, sql, backend=None, ttl=QUERY_CACHE_TTL, check_interval=GENERATION_CHECK_INTERVAL):
+        self.sql = sql
+        self.backend = backend or MemoryCache(QUERY_CACHE_SIZE)
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.checked = None
+
+    def current_generations(self):
+        now = time.monotonic()
+
+        with self.lock:
+            if self.checked is not None and now - self.checked < self.check_interval:
+                return self.generations
+
+            self.checked = now
+
+        try:
+            rows = self.sql.run_query(data_generations_query)
+            generations = dict(zip(rows['table_name'].str.lower(), rows['generation']))
+        except Exception as e:
+            logging.warning(f'Unable to read data generations: {e}')
+            return self.generations
+
+        with self.lock:
+            self.generations = generations
+
+        return generations
+
+    def refresh_generations(self):
+        """
+        re-reads the generations on their next use rather than after up to `check_interval` seconds
+        """
+        with self.lock:
+            self.checked = None
+
+    def snapshot(self, tables):
+        generations = self.current_generations()
+        return tuple(int(generations.get(t.lower(), 0)) for t in tables)
+
+    def get_or_compute(self, key, tables, compute):
+        """
+        keys and snapshots are passed to the backend as their repr, so they have to be built from plain values
+        """
+        return self.backend.get_or_compute(repr(key), repr(self.snapshot(tables)), compute, self.ttl)
+
+    def run_query(self, query, **params):
+        """
+        same as sql.run_query, served from the cache while the tables it reads are unchanged
+        returns a copy, so callers can modify the frame without touching the cached one
+        """
+        key = (query.name, tuple(query.bind(**params)))
+        return self.get_or_compute(key, query.tables, lambda: self.sql.run_query(query, **params)).copy()
+
+    def clear(self):
+        self.backend.clear()
+        self.refresh_generations()
+
+    def stats(self):
+        with self.lock:
+            generations = {k: int(v) for k, v in self.generations.items()}
+
+        return {**self.backend.stats(), 'generations': generations}
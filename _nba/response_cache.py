@@ -0,0 +1,158 @@
+import os
+import gzip
+import hashlib
+import logging
+import threading
+
+CACHE_DIR = os.environ.get('NBA_CACHE_DIR', os.path.join(os.getcwd(), 'cache'))
+CACHE_MAX_BYTES = int(os.environ.get('NBA_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+
+MUTABLE_SUFFIX = '.json.gz'
+IMMUTABLE_SUFFIX = '.final.json.gz'
+
+_replay = os.environ.get('NBA_REPLAY') == '1'
+
+
+def set_replay_mode(enabled=True):
+    global _replay
+    _replay = enabled
+    logging.info(f'Replay mode: {enabled}')
+
+
+def replay_mode():
+    return _replay
+
+
+class ResponseCache:
+    """
+    gzip compressed raw responses on disk, one file per url named by the sha256 of the url
+    the total size is bounded by evicting the least recently used entries, recency survives restarts through mtime
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def path(self, key, immutable):
+        return os.path.join(self.cache_dir, key[:2], key + (IMMUTABLE_SUFFIX if immutable else MUTABLE_SUFFIX))
+
+    def load_index(self):
+        self.index = {}
+        self.total_bytes = 0
+
+        if not os.path.exists(self.cache_dir):
+            return
+
+        for folder in os.scandir(self.cache_dir):
+            if not folder.is_dir():
+                continue
+
+            for entry in os.scandir(folder.path):
+                if not entry.name.endswith(MUTABLE_SUFFIX):
+                    continue
+
+                stat = entry.stat()
+                immutable = entry.name.endswith(IMMUTABLE_SUFFIX)
+                key = entry.name[:-len(IMMUTABLE_SUFFIX if immutable else MUTABLE_SUFFIX)]
+
+                self.index[key] = [stat.st_mtime, stat.st_size, immutable]
+                self.total_bytes += stat.st_size
+
+    def ensure_index(self):
+        if self.index is None:
+            self.load_index()
+
+    def get(self, url):
+        key = self.key(url)
+
+        with self.lock:
+            self.ensure_index()
+            entry = self.index.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None, False
+
+            path = self.path(key, entry[2])
+            try:
+                os.utime(path)
+            except OSError:
+                self.remove(key)
+                self.misses += 1
+                return None, False
+
+            entry[0] = os.path.getmtime(path)
+            self.hits += 1
+            immutable = entry[2]
+
+        # read outside the lock, so the file can be evicted meanwhile. that, or a corrupt file, is a miss
+        try:
+            with gzip.open(path, 'rb') as f:
+                return f.read(), immutable
+        except (OSError, EOFError) as e:
+            logging.warning(f'Response cache read failed for {url}: {e}')
+
+            with self.lock:
+                if key in self.index:
+                    self.remove(key)
+
+                self.hits -= 1
+                self.misses += 1
+
+            return None, False
+
+    def put(self, url, content, immutable=False):
+        if self.max_bytes <= 0:
+            return
+
+        key = self.key(url)
+        path = self.path(key, immutable)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(content)
+
+        with self.lock:
+            self.ensure_index()
+            if key in self.index:
+                self.remove(key)
+
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            self.index[key] = [os.path.getmtime(path), size, immutable]
+            self.total_bytes += size
+
+            self.evict()
+
+    def remove(self, key):
+        _, size, immutable = self.index.pop(key)
+        self.total_bytes -= size
+
+        try:
+            os.remove(self.path(key, immutable))
+        except OSError:
+            pass
+
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        for key, _ in sorted(self.index.items(), key=lambda i: i[1][0]):
+            self.remove(key)
+
+            if self.total_bytes <= self.max_bytes:
+                break
+
+        logging.info(f'Response cache evicted to {self.total_bytes} bytes')
+
+
+response_cache = ResponseCache()
@@ -1,10 +1,11 @@
 import time
-import requests
 import datetime
 import logging
 from teams import TEAMS
-from shared_modules import SqlConnection, create_logger
+from shared_modules import SqlConnection, create_logger, http_get, request_stats
 from nba_settings import current_roster_1, headers, Referer
+from query_cache import bump_generations
+from prewarm import request_prewarm
 
 
 def current_roster(current_season, team, sql):
@@ -15,7 +16,7 @@ def current_roster(current_season, team, sql):
     url = '{0}{1}&TeamID={2}'.format(current_roster_1, str(current_season), str(team))
     headers['Referer'] = Referer.format(team)
     try:
-        roster_rqst = requests.request('GET', url, headers=headers)
+        roster_rqst = http_get(url, headers=headers)
         roster = roster_rqst.json()
 
         roster_lst.append(roster['resultSets'][0]['rowSet'])
@@ -31,6 +32,7 @@ def current_roster(current_season, team, sql):
 
     rosters = [dict(zip(data_headers, player)) for team in roster_lst for player in team]
     sql.insert_data('rosters', rosters)
+    bump_generations(sql, ['rosters'])
 
 
 def get_rosters():
@@ -43,6 +45,8 @@ def get_rosters():
     for team in team_ids:
         current_roster(current_season, team, sql)
 
+    request_prewarm()
+    request_stats.log()
     logging.info('Task completed')
 
 
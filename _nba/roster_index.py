@@ -0,0 +1,28 @@
+import pandas as pd
+from sql_queries import CURRENT_ROSTER_COLUMNS
+
+
+class RosterIndex:
+    """
+    the current league roster from a single query, indexed by player_id and team_id for constant time lookups
+    ids are stored as strings, as the rosters table holds them
+    """
+    def __init__(self, roster):
+        # a player with two rows updated at the same latest time would otherwise be listed twice on their team
+        self.roster = roster.drop_duplicates('player_id', keep='last')
+        self.players = {}
+        self.teams = {}
+
+        for player in self.roster.to_dict('records'):
+            self.players[str(player['player_id'])] = player
+            self.teams.setdefault(str(player['team_id']), []).append(player)
+
+    def player(self, player_id):
+        return self.players.get(str(player_id))
+
+    def player_name(self, player_id, default='Name Missing'):
+        player = self.player(player_id)
+        return player['Player'] if player is not None else default
+
+    def team(self, team_id):
+        return pd.DataFrame(self.teams.get(str(team_id), []), columns=CURRENT_ROSTER_COLUMNS)
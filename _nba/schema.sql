@@ -1,3 +1,5 @@
+-- keys and indexes for these tables are declared in schema_management.py
+
 
 CREATE TABLE [dbo].[games]
 (
@@ -10,6 +12,7 @@ CREATE TABLE [dbo].[games]
 	[home_team_id] [bigint] NULL,
 	[home_score] [int] NULL,
 	[season] [varchar](10) NULL,
+	[status] [varchar](10) NULL,
     [LastUpdated] [datetime] NOT NULL DEFAULT (getdate())
 );
 GO
@@ -118,3 +121,119 @@ CREATE TABLE [dbo].[rosters]
 	[LastUpdated] [datetime] NOT NULL DEFAULT (getdate())
 );
 GO
+
+
+-- maintained by derived_tables.py for the games each load writes
+CREATE TABLE [dbo].[team_game_stats]
+(
+    [gid] [bigint] NOT NULL,
+    [tid] [bigint] NOT NULL,
+    [season] [varchar](10) NULL,
+    [players] [int] NULL,
+    [ast] [bigint] NULL,
+    [blk] [bigint] NULL,
+    [blka] [bigint] NULL,
+    [dreb] [bigint] NULL,
+    [fbpts] [bigint] NULL,
+    [fbptsa] [bigint] NULL,
+    [fbptsm] [bigint] NULL,
+    [fga] [bigint] NULL,
+    [fgm] [bigint] NULL,
+    [fta] [bigint] NULL,
+    [ftm] [bigint] NULL,
+    [oreb] [bigint] NULL,
+    [pf] [bigint] NULL,
+    [pip] [bigint] NULL,
+    [pipa] [bigint] NULL,
+    [pipm] [bigint] NULL,
+    [pts] [bigint] NULL,
+    [reb] [bigint] NULL,
+    [stl] [bigint] NULL,
+    [tov] [bigint] NULL,
+    [tpa] [bigint] NULL,
+    [tpm] [bigint] NULL,
+    [LastUpdated] [datetime] NOT NULL DEFAULT (getdate())
+);
+GO
+
+
+-- maintained by derived_tables.py for the games each load writes
+CREATE TABLE [dbo].[team_season_stats]
+(
+    [tid] [bigint] NOT NULL,
+    [season] [varchar](10) NOT NULL,
+    [games] [int] NULL,
+    [ast] [bigint] NULL,
+    [blk] [bigint] NULL,
+    [blka] [bigint] NULL,
+    [dreb] [bigint] NULL,
+    [fbpts] [bigint] NULL,
+    [fbptsa] [bigint] NULL,
+    [fbptsm] [bigint] NULL,
+    [fga] [bigint] NULL,
+    [fgm] [bigint] NULL,
+    [fta] [bigint] NULL,
+    [ftm] [bigint] NULL,
+    [oreb] [bigint] NULL,
+    [pf] [bigint] NULL,
+    [pip] [bigint] NULL,
+    [pipa] [bigint] NULL,
+    [pipm] [bigint] NULL,
+    [pts] [bigint] NULL,
+    [reb] [bigint] NULL,
+    [stl] [bigint] NULL,
+    [tov] [bigint] NULL,
+    [tpa] [bigint] NULL,
+    [tpm] [bigint] NULL,
+    [LastUpdated] [datetime] NOT NULL DEFAULT (getdate())
+);
+GO
+
+
+-- maintained by derived_tables.py for the games each load writes
+CREATE TABLE [dbo].[player_season_shooting]
+(
+    [season] [varchar](10) NOT NULL,
+    [tid] [bigint] NOT NULL,
+    [pid] [bigint] NOT NULL,
+    [player] [nvarchar](61) NULL,
+    [appearances] [int] NULL,
+    [starts] [int] NULL,
+    [fbpts] [bigint] NULL,
+    [fbptsm] [bigint] NULL,
+    [fbptsa] [bigint] NULL,
+    [fgm] [bigint] NULL,
+    [fga] [bigint] NULL,
+    [ftm] [bigint] NULL,
+    [fta] [bigint] NULL,
+    [pip] [bigint] NULL,
+    [pipm] [bigint] NULL,
+    [pipa] [bigint] NULL,
+    [pts] [bigint] NULL,
+    [tpm] [bigint] NULL,
+    [tpa] [bigint] NULL,
+    [LastUpdated] [datetime] NOT NULL DEFAULT (getdate())
+);
+GO
+
+
+-- maintained by derived_tables.py, placed on the ps_season partitions by its clustered index
+CREATE TABLE [dbo].[shots]
+(
+    [season] [varchar](10) NOT NULL,
+    [gid] [bigint] NOT NULL,
+    [evt] [bigint] NOT NULL,
+    [pid] [bigint] NOT NULL,
+    [tid] [bigint] NOT NULL,
+    [opp_tid] [bigint] NULL,
+    [period] [tinyint] NULL,
+    [cl] [nvarchar](10) NULL,
+    [de] [nvarchar](255) NULL,
+    [etype] [tinyint] NOT NULL,
+    [made] [bit] NOT NULL,
+    [locX] [smallint] NULL,
+    [locY] [smallint] NULL,
+    [distance] [real] NULL,
+    [LastUpdated] [datetime] NOT NULL DEFAULT (getdate())
+);
+GO
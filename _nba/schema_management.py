@@ -0,0 +1,172 @@
+import sys
+import logging
+from shared_modules import SqlConnection, create_logger
+
+# natural keys the ingestion MERGEs join on, each table is clustered on its keys
+upsert_keys = {
+    'games': ['game_id'],
+    'game_stats': ['gid', 'tid', 'pid'],
+    'game_pbp': ['gid', 'evt']
+}
+
+GAME_STATS_INCLUDE = ['ast', 'blk', 'blka', 'dreb', 'fbpts', 'fbptsa', 'fbptsm', 'fga', 'fgm', 'fta', 'ftm', 'oreb',
+                      'pf', 'pip', 'pipa', 'pipm', 'pos', 'pts', 'reb', 'stl', 'tov', 'tpa', 'tpm']
+
+SHOT_INCLUDE = ['cl', 'de', 'evt', 'locX', 'locY', 'period']
+
+SHOT_STORE_INCLUDE = ['opp_tid', 'period', 'cl', 'de', 'etype', 'made', 'locX', 'locY', 'distance']
+
+# one partition per season, seasons outside the boundaries are split in by apply_partitions
+SEASON_PARTITION_FUNCTION = 'pf_season'
+SEASON_PARTITION_SCHEME = 'ps_season'
+SEASON_BOUNDARIES = [f'{year}-{year + 1}' for year in range(2016, 2031)]
+
+INDEXES = {
+    'games': [
+        {'name': 'cx_games', 'columns': upsert_keys['games'], 'clustered': True},
+        {'name': 'ix_games_season', 'columns': ['season'],
+         'include': ['game_id', 'date', 'venue', 'home_team_id', 'away_team_id']}
+    ],
+    'game_stats': [
+        {'name': 'cx_game_stats', 'columns': upsert_keys['game_stats'], 'clustered': True},
+        {'name': 'ix_game_stats_tid', 'columns': ['tid', 'gid'], 'include': ['pid'] + GAME_STATS_INCLUDE},
+        {'name': 'ix_game_stats_pid', 'columns': ['pid', 'gid'], 'include': ['tid'] + GAME_STATS_INCLUDE}
+    ],
+    'game_pbp': [
+        {'name': 'cx_game_pbp', 'columns': upsert_keys['game_pbp'], 'clustered': True},
+        {'name': 'ix_game_pbp_pid_etype', 'columns': ['pid', 'etype'], 'include': ['tid'] + SHOT_INCLUDE},
+        {'name': 'ix_game_pbp_tid_etype', 'columns': ['tid', 'etype'], 'include': ['pid'] + SHOT_INCLUDE}
+    ],
+    'rosters': [
+        {'name': 'ix_rosters_teamid_season', 'columns': ['teamid', 'season'], 'include': ['player_id', 'LastUpdated']},
+        {'name': 'ix_rosters_player_id', 'columns': ['player_id', 'LastUpdated']}
+    ],
+    'team_game_stats': [
+        {'name': 'cx_team_game_stats', 'columns': ['gid', 'tid'], 'clustered': True},
+        {'name': 'ix_team_game_stats_tid_season', 'columns': ['tid', 'season']}
+    ],
+    'team_season_stats': [
+        {'name': 'cx_team_season_stats', 'columns': ['season', 'tid'], 'clustered': True}
+    ],
+    'player_season_shooting': [
+        {'name': 'cx_player_season_shooting', 'columns': ['season', 'tid', 'pid'], 'clustered': True}
+    ],
+    'shots': [
+        {'name': 'cx_shots', 'columns': ['season', 'gid', 'evt'], 'clustered': True, 'partitioned': True},
+        {'name': 'ix_shots_pid', 'columns': ['season', 'pid', 'gid', 'evt'], 'include': ['tid'] + SHOT_STORE_INCLUDE,
+         'partitioned': True},
+        {'name': 'ix_shots_tid', 'columns': ['season', 'tid', 'gid', 'evt'], 'include': ['pid'] + SHOT_STORE_INCLUDE,
+         'partitioned': True}
+    ],
+    'position_clusters': [
+        {'name': 'ix_position_clusters_season', 'columns': ['Season']}
+    ]
+}
+
+create_index_query = '''
+IF OBJECT_ID('[dbo].[{table}]') IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM sys.indexes WHERE [name] = '{name}' AND [object_id] = OBJECT_ID('[dbo].[{table}]'))
+CREATE {kind} INDEX [{name}] ON [dbo].[{table}] ( {columns} ){include}{partition}
+'''
+
+create_partition_query = f'''
+IF NOT EXISTS (SELECT 1 FROM sys.partition_functions WHERE [name] = '{SEASON_PARTITION_FUNCTION}')
+BEGIN
+    CREATE PARTITION FUNCTION [{SEASON_PARTITION_FUNCTION}] ([varchar](10)) AS RANGE RIGHT FOR VALUES ('{SEASON_BOUNDARIES[0]}')
+    CREATE PARTITION SCHEME [{SEASON_PARTITION_SCHEME}] AS PARTITION [{SEASON_PARTITION_FUNCTION}] ALL TO ([PRIMARY])
+END
+'''
+
+partition_boundaries_query = f'''
+SELECT CAST(v.[value] AS varchar(10))
+FROM sys.partition_range_values v
+JOIN sys.partition_functions f ON f.function_id = v.function_id
+WHERE f.[name] = '{SEASON_PARTITION_FUNCTION}'
+'''
+
+split_partition_query = f'''
+ALTER PARTITION SCHEME [{SEASON_PARTITION_SCHEME}] NEXT USED [PRIMARY]
+ALTER PARTITION FUNCTION [{SEASON_PARTITION_FUNCTION}] () SPLIT RANGE ('{{0}}')
+'''
+
+drop_index_query = '''
+IF EXISTS (SELECT 1 FROM sys.indexes WHERE [name] = '{name}' AND [object_id] = OBJECT_ID('[dbo].[{table}]'))
+DROP INDEX [{name}] ON [dbo].[{table}]
+'''
+
+
+def index_statement(table_name, index):
+    include = index.get('include')
+
+    return create_index_query.format(
+        table=table_name,
+        name=index['name'],
+        kind='CLUSTERED' if index.get('clustered') else 'NONCLUSTERED',
+        columns=', '.join(f'[{c}]' for c in index['columns']),
+        include=' INCLUDE ( {0} )'.format(', '.join(f'[{c}]' for c in include)) if include else '',
+        partition=f' ON [{SEASON_PARTITION_SCHEME}] ([season])' if index.get('partitioned') else '')
+
+
+def apply_partitions(sql):
+    """
+    creates the season partition function and scheme, and splits in any season boundary it doesn't have yet
+    """
+    sql.cursor.execute(create_partition_query)
+    existing = {r[0] for r in sql.cursor.execute(partition_boundaries_query).fetchall()}
+
+    for season in SEASON_BOUNDARIES:
+        if season not in existing:
+            sql.cursor.execute(split_partition_query.format(season))
+
+
+def apply_indexes(sql, tables=None):
+    """
+    creates every declared index that doesn't exist yet, clustered indexes first
+    tables that don't exist are skipped, an index that can't be built is logged and the rest carry on
+    """
+    tables = tables or list(INDEXES.keys())
+    if any(index.get('partitioned') for table_name in tables for index in INDEXES[table_name]):
+        apply_partitions(sql)
+
+    for table_name in tables:
+        for index in sorted(INDEXES[table_name], key=lambda i: not i.get('clustered')):
+            try:
+                sql.cursor.execute(index_statement(table_name, index))
+            except Exception as e:
+                logging.error(f"Unable to create {table_name}.{index['name']}: {e}")
+                print(e)
+
+        logging.info(f'Indexes applied: {table_name}')
+
+
+def drop_indexes(sql, tables=None):
+    for table_name in tables or INDEXES.keys():
+        for index in sorted(INDEXES[table_name], key=lambda i: bool(i.get('clustered'))):
+            sql.cursor.execute(drop_index_query.format(table=table_name, name=index['name']))
+
+
+def migrate_tables(sql, tables=None, dry_run=False):
+    """
+    converts the varchar columns of the ingested tables to typed columns, see SqlConnection.migrate_column_types
+    """
+    for table_name in tables or upsert_keys.keys():
+        migrated = sql.migrate_column_types(table_name, dry_run=dry_run)
+        print(f'{table_name}: {migrated}')
+
+
+def main():
+    create_logger(__file__)
+
+    sql = SqlConnection('nba')
+
+    # python schema_management.py --migrate [table ...] [--dry-run]
+    if '--migrate' in sys.argv:
+        tables = [a for a in sys.argv[1:] if not a.startswith('--')]
+        migrate_tables(sql, tables, dry_run='--dry-run' in sys.argv)
+        return
+
+    apply_indexes(sql)
+
+
+if __name__ == '__main__':
+    main()
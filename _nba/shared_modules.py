@@ -1,12 +1,111 @@
 import os
+import re
+import math
 import pyodbc
 import time
+import numbers
+import decimal
+import datetime
 import logging
+import queue
+import threading
+import numpy as np
 import pandas as pd
 import logging
+import json
 import requests
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from nba_settings import headers
 from shared_config import uid, pwd
+from response_cache import response_cache, replay_mode
+from pipeline import batched
+
+FETCH_WORKERS = 8
+FETCH_RATE = 10.0
+FETCH_BURST = 10
+
+HTTP_POOL_SIZE = FETCH_WORKERS * 2
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 0.5
+HTTP_BACKOFF_MAX = 30
+HTTP_TIMEOUT = 60
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+POOL_SIZE = 8
+POOL_TIMEOUT = 30
+POOL_HEALTH_CHECK_INTERVAL = 30
+CONNECTION_ERROR_STATES = ('08S01', '08001', '08003', '08004', '08007', 'HYT00', 'HYT01')
+
+FETCH_CHUNK_SIZE = 5000
+CATEGORICAL_MIN_ROWS = 50
+CATEGORICAL_RATIO = 0.5
+
+INSERT_BATCH_SIZE = 10000
+STAGING_COLUMN_TYPE = '[nvarchar](4000)'
+
+TYPE_SAMPLE_SIZE = 1000
+DEFAULT_COLUMN_TYPE = '[varchar](100)'
+DATETIME_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$')
+NULL_STRINGS = ('', 'None')
+STRING_TYPES = ('char', 'varchar', 'nchar', 'nvarchar', 'text', 'ntext')
+INTEGER_LIMITS = {'tinyint': 2 ** 8, 'smallint': 2 ** 15, 'int': 2 ** 31, 'bigint': 2 ** 63}
+FLOAT_TYPES = ('float', 'real', 'decimal', 'numeric')
+DATETIME_TYPES = ('date', 'datetime', 'datetime2', 'smalldatetime')
+BIT_STRINGS = ('0', '1', 'True', 'False')
+INTEGER_PATTERN = re.compile(r'^-?\d+$')
+
+
+schema_columns_query = '''
+SET NOCOUNT ON;
+BEGIN
+SELECT 
+    [TABLE_NAME]
+    ,[COLUMN_NAME]
+    ,[DATA_TYPE]
+    ,[CHARACTER_MAXIMUM_LENGTH]
+FROM INFORMATION_SCHEMA.COLUMNS
+WHERE [TABLE_SCHEMA] = 'dbo'
+END
+'''
+
+varchar_columns_query = '''
+SET NOCOUNT ON;
+BEGIN
+SELECT 
+    [COLUMN_NAME]
+    ,[DATA_TYPE]
+    ,[CHARACTER_MAXIMUM_LENGTH]
+FROM INFORMATION_SCHEMA.COLUMNS
+WHERE [TABLE_NAME] = '{0}'
+AND [DATA_TYPE] IN ('varchar', 'nvarchar')
+END
+'''
+
+COLUMN_TYPE_PROBE_COLUMNS = ['non_null', 'not_bigint', 'not_float', 'not_datetime', 'leading_zeros', 'max_abs',
+                             'max_length']
+
+column_type_probe_query = '''
+SET NOCOUNT ON;
+BEGIN
+SELECT 
+    COUNT([v])
+    ,COUNT(CASE WHEN TRY_CAST([v] AS bigint) IS NULL THEN [v] END)
+    ,COUNT(CASE WHEN TRY_CAST([v] AS float) IS NULL THEN [v] END)
+    ,COUNT(CASE WHEN [v] NOT LIKE '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]%' OR TRY_CAST([v] AS datetime) IS NULL THEN [v] END)
+    ,COUNT(CASE WHEN [v] LIKE '0[0-9]%' THEN [v] END)
+    ,ISNULL(MAX(ABS(TRY_CAST([v] AS float))), 0)
+    ,ISNULL(MAX(LEN([v])), 0)
+FROM (
+    SELECT NULLIF(NULLIF(LTRIM(RTRIM([{1}])), ''), 'None') AS [v]
+    FROM [dbo].[{0}]
+) t
+END
+'''
 
 
 class SqlConnection:
@@ -21,6 +120,8 @@ class SqlConnection:
         self.autocommit = True
         self.conn = self.sql_server_connection()
         self.cursor = self.conn.cursor()
+        self.schema = None
+        self.schema_types = None
 
     def sql_server_connection(self):
         try:
@@ -35,24 +136,54 @@ class SqlConnection:
                 autocommit=self.autocommit
             )
 
-        except Exception as e:
-            logging.info(e)
+        except pyodbc.Error as e:
+            logging.error(e)
+            raise
+
+    def execute(self, query, params=None):
+        if params:
+            return self.cursor.execute(query, params)
+        return self.cursor.execute(query)
 
-    def load_data(self, query, columns=None):
+    def load_data(self, query, columns=None, chunksize=FETCH_CHUNK_SIZE, params=None):
         if not columns:
-            self.cursor.execute(query)
+            self.execute(query, params)
             print('Command executed:', query)
             return
 
-        rows = self.cursor.execute(query).fetchall()
+        self.execute(query, params)
+
+        column_values = [[] for _ in columns]
+        while True:
+            rows = self.cursor.fetchmany(chunksize)
+            if not rows:
+                break
+
+            for values, column in zip(zip(*rows), column_values):
+                column.extend(values)
+
+        return columnar_frame(columns, column_values, self.cursor.description)
+
+    def run_query(self, query, **params):
+        """
+        runs a query registered in sql_queries with its parameters bound rather than formatted into the sql,
+        re-running the same query on this cursor reuses the prepared statement
+        """
+        return self.load_data(query.sql, query.columns, params=query.bind(**params))
 
-        sql_data = []
-        for row in rows:
-            sql_data.append(list(row))
+    def load_data_chunks(self, query, columns, chunksize=FETCH_CHUNK_SIZE, params=None):
+        """
+        same as load_data, but yields a DataFrame per chunk of rows so large results are never held at once
+        """
+        self.execute(query, params)
+        description = self.cursor.description
 
-        df = pd.DataFrame(sql_data, columns=columns)
+        while True:
+            rows = self.cursor.fetchmany(chunksize)
+            if not rows:
+                return
 
-        return df
+            yield columnar_frame(columns, [list(values) for values in zip(*rows)], description)
 
     def truncate_table(self, table_name):
         if self.check_if_table_exists(table_name, create=False):
@@ -75,31 +206,171 @@ class SqlConnection:
         self.cursor.commit()
         print(f'Table created: {table_name}')
 
+        if self.schema is not None:
+            self.schema[table_name.lower()] = {c.lower(): c for c in list(table_columns) + ['LastUpdated']}
+            types = table_columns if isinstance(table_columns, dict) else \
+                dict.fromkeys(table_columns, DEFAULT_COLUMN_TYPE)
+            self.schema_types[table_name.lower()] = {c.lower(): parse_column_type(t) for c, t in types.items()}
+
     def drop_table(self, table_name):
         query = 'DROP TABLE {0}'
         self.cursor.execute(query.format(table_name))
 
+        if self.schema is not None:
+            self.schema.pop(table_name.lower().split('.')[-1].strip('[]'), None)
+            self.schema_types.pop(table_name.lower().split('.')[-1].strip('[]'), None)
+
+    def load_schema(self):
+        schema = {}
+        schema_types = {}
+        for table_name, column_name, data_type, length in self.cursor.execute(schema_columns_query).fetchall():
+            schema.setdefault(table_name.lower(), {})[column_name.lower()] = column_name
+            schema_types.setdefault(table_name.lower(), {})[column_name.lower()] = (data_type.lower(), length)
+
+        self.schema = schema
+        self.schema_types = schema_types
+
+    def invalidate_schema(self):
+        self.schema = None
+        self.schema_types = None
+
+    def column_types(self, table_name):
+        """
+        (data type, character length) of each column of table_name keyed by its lower case name, a length of -1 is max
+        kept up to date along with table_columns
+        """
+        if self.schema is None:
+            self.load_schema()
+
+        return self.schema_types.get(table_name.lower(), {})
+
+    def typed_columns(self, table_name, columns):
+        """
+        the columns of table_name that aren't strings, where empty and 'None' strings are inserted as NULL
+        """
+        column_types = self.column_types(table_name)
+        return {c for c in columns if column_types.get(c.lower(), ('nvarchar', None))[0] not in STRING_TYPES}
+
+    def widen_columns(self, table_name, data):
+        """
+        alters the columns of table_name that can't hold the values about to be inserted, as a table's types are
+        inferred from the rows it's created with and later rows can hold longer strings, larger ids or decimals
+        a column that can't be altered, eg. an indexed one changing type, is left for the insert to fail on
+        """
+        column_types = self.column_types(table_name)
+
+        for column in ordered_columns(data):
+            if column.lower() not in column_types:
+                continue
+
+            column_type = widened_column_type([d.get(column) for d in data], *column_types[column.lower()])
+            if column_type is None:
+                continue
+
+            try:
+                with self.conn:
+                    self.cursor.execute(
+                        f'ALTER TABLE [dbo].[{table_name}] ALTER COLUMN [{column}] {column_type} NULL')
+            except pyodbc.Error as e:
+                logging.warning(f'{table_name}.{column}: unable to widen to {column_type}: {e}')
+                continue
+
+            column_types[column.lower()] = parse_column_type(column_type)
+            logging.info(f'{table_name}.{column}: widened to {column_type}')
+
+    def table_columns(self, table_name):
+        """
+        column names of table_name keyed by their lower case name, or None if the table doesn't exist
+        tables and columns are read from INFORMATION_SCHEMA once per connection and kept up to date by
+        create_table, drop_table and add_missing_columns. call invalidate_schema after changing tables any other way
+        """
+        if self.schema is None:
+            self.load_schema()
+
+        return self.schema.get(table_name.lower())
+
+    def add_missing_columns(self, table_name, data):
+        existing = self.table_columns(table_name)
+        missing = [c for c in ordered_columns(data) if c.lower() not in existing]
+
+        if not missing:
+            return
+
+        column_types = infer_column_types(data, missing)
+        self.cursor.execute('ALTER TABLE [dbo].[{0}] ADD {1}'.format(
+            table_name, create_table_columns_statement(column_types)))
+
+        existing.update({c.lower(): c for c in missing})
+        self.schema_types[table_name.lower()].update({c.lower(): parse_column_type(t) for c, t in column_types.items()})
+        logging.info(f'{table_name}: columns added {column_types}')
+
     def check_if_table_exists(self, table_name, table_columns=None, override=False, create=True):
         if override:
             self.drop_table(table_name)
 
-        query = "IF EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = N'{0}') SELECT 1 ELSE SELECT 0"
-        table_check = self.load_data(query.format(table_name), ['A'])
+        if self.table_columns(table_name) is not None:
+            return True
 
-        if table_check['A'].loc[0] == 0 and create:
+        if create:
             self.create_table(table_name, table_columns)
-        else:
-            return True
 
-    def insert_data(self, table_name, data, key_columns=None, verbose=1):
+        return False
+
+    def migrate_column_types(self, table_name, dry_run=False):
+        """
+        converts the varchar columns of an existing table in place to the narrowest type every stored value fits
+        empty and 'None' strings become NULL in the columns converted to another type, values with leading zeros
+        (eg. game ids) stay strings
+        """
+        columns = self.load_data(varchar_columns_query.format(table_name), ['column_name', 'data_type', 'length'])
+
+        migrated = {}
+        for column in columns['column_name']:
+            probe = self.load_data(column_type_probe_query.format(table_name, column), COLUMN_TYPE_PROBE_COLUMNS)
+            column_type = probed_column_type(probe.to_dict('records')[0])
+
+            migrated[column] = column_type
+            logging.info(f'{table_name}.{column}: {column_type}')
+
+            if dry_run:
+                continue
+
+            with self.conn:
+                if parse_column_type(column_type)[0] not in STRING_TYPES:
+                    self.cursor.execute(
+                        "UPDATE [dbo].[{0}] SET [{1}] = NULL WHERE LTRIM(RTRIM([{1}])) IN ('', 'None')".format(
+                            table_name, column))
+                self.cursor.execute(f'ALTER TABLE [dbo].[{table_name}] ALTER COLUMN [{column}] {column_type} NULL')
+
+        if not dry_run:
+            self.invalidate_schema()
+
+        return migrated
+
+    def insert_data(self, table_name, data, key_columns=None, verbose=1, method='executemany',
+                    batch_size=INSERT_BATCH_SIZE):
         if type(data) != list:
             print('Data must be a list of dicts')
             return
 
-        all_keys = set().union(*(d.keys() for d in data))
+        if not self.check_if_table_exists(table_name, create=False):
+            self.create_table(table_name, infer_column_types(data))
+        else:
+            self.add_missing_columns(table_name, data)
 
-        self.check_if_table_exists(table_name, all_keys)
+        self.widen_columns(table_name, data)
 
+        if method == 'values':
+            self.insert_values(table_name, data, key_columns)
+        else:
+            self.bulk_insert(table_name, data, key_columns, batch_size)
+
+        logging.info('{0}: {1} rows inserted'.format(table_name, len(data)))
+
+        if verbose > 0:
+            print('{0}: {1} rows inserted'.format(table_name, len(data)))
+
+    def insert_values(self, table_name, data, key_columns=None):
         if key_columns:
             query = 'SELECT * INTO #temp FROM ( VALUES {0} ) AS s ( {1} ) ' \
                     'MERGE INTO [{6}].[dbo].[{2}] as Target ' \
@@ -124,19 +395,410 @@ class SqlConnection:
         with self.conn:
             self.cursor.execute(query)
 
-        logging.info('{0}: {1} rows inserted'.format(table_name, len(data)))
+    def bulk_insert(self, table_name, data, key_columns=None, batch_size=INSERT_BATCH_SIZE):
+        """
+        sends rows as bound parameters with fast_executemany, batch_size rows per round trip
+        with key_columns the rows go to a #staging table first and are upserted with a single MERGE
+        """
+        columns = ordered_columns(data)
+        column_list = ', '.join(f'[{c}]' for c in columns)
+        staging_table = f'#{table_name}_staging'
+        target_table = f'[dbo].[{table_name}]'
+
+        insert_query = 'INSERT INTO {0} ( {1} ) VALUES ( {2} )'.format(
+            staging_table if key_columns else target_table, column_list, ', '.join('?' for _ in columns))
+
+        typed = self.typed_columns(table_name, columns)
+        rows = (tuple(parameter_value(d.get(c), c in typed) for c in columns) for d in data)
+
+        self.conn.autocommit = False
+        try:
+            if key_columns:
+                self.cursor.execute(f"IF OBJECT_ID('tempdb..{staging_table}') IS NOT NULL DROP TABLE {staging_table}")
+                self.cursor.execute('CREATE TABLE {0} ( {1} )'.format(
+                    staging_table, ', '.join(f'[{c}] {STAGING_COLUMN_TYPE} NULL' for c in columns)))
+
+            self.cursor.fast_executemany = True
+            for batch in batched(rows, batch_size):
+                self.cursor.executemany(insert_query, batch)
+
+            if key_columns:
+                self.cursor.execute(merge_statement(target_table, staging_table, columns, key_columns))
+                self.cursor.execute(f'DROP TABLE {staging_table}')
+
+            self.conn.commit()
+
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        finally:
+            self.cursor.fast_executemany = False
+            self.conn.autocommit = self.autocommit
+
+
+class ConnectionPool:
+    """
+    bounded pool of SqlConnections handed out one per request, so concurrent callbacks never share a cursor
+    connections are opened on demand, pinged before reuse when they've been idle longer than health_check_interval
+    and replaced when they fail with a connection error
+    creating a pool opens nothing, and a pool inherited by a forked worker drops the parent's state as it's forked
+    """
+    def __init__(self, database, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 health_check_interval=POOL_HEALTH_CHECK_INTERVAL):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.reset()
+
+        # connections opened before a fork share their sockets with the parent, never reuse them. resetting in the
+        # child as it's forked, before any of its threads run, leaves no thread holding the parent's semaphore
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self.idle = queue.LifoQueue()
+        self.available = threading.BoundedSemaphore(self.size)
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=10000)
+        self.counts = defaultdict(int)
+
+    def connect(self):
+        # raised to the caller, a connection error is then retried once by load_data
+        try:
+            sql = SqlConnection(self.database)
+        except pyodbc.Error:
+            self.count('failed_connects')
+            raise
+
+        self.count('opened')
+        return sql
+
+    def close(self, sql):
+        try:
+            sql.conn.close()
+        except Exception as e:
+            logging.info(e)
+
+        self.count('closed')
+
+    def healthy(self, sql):
+        try:
+            sql.cursor.execute('SELECT 1').fetchall()
+            return True
+        except pyodbc.Error as e:
+            logging.warning(f'Pooled connection failed health check: {e}')
+            self.count('failed_health_checks')
+            return False
+
+    def checkout(self):
+        while True:
+            try:
+                sql, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+
+            if time.monotonic() - last_used < self.health_check_interval or self.healthy(sql):
+                return sql
+
+            self.close(sql)
+
+    @contextmanager
+    def connection(self):
+        idle, available = self.idle, self.available
+
+        start = time.perf_counter()
+        if not available.acquire(timeout=self.timeout):
+            self.count('timeouts')
+            raise TimeoutError(f'No {self.database} connection available after {self.timeout}s')
+
+        # the waits are only kept for the percentiles, checkouts are counted apart as they outnumber them
+        with self.lock:
+            self.waits.append(time.perf_counter() - start)
+            self.counts['checkouts'] += 1
+
+        sql = None
+        try:
+            sql = self.checkout()
+            yield sql
+
+        except pyodbc.Error as e:
+            if sql is not None and is_connection_error(e):
+                self.close(sql)
+                sql = None
+            raise
+
+        finally:
+            if sql is not None:
+                idle.put((sql, time.monotonic()))
+            available.release()
+
+    def load_data(self, query, columns=None, **kwargs):
+        try:
+            with self.connection() as sql:
+                return sql.load_data(query, columns, **kwargs)
+
+        except pyodbc.Error as e:
+            if not is_connection_error(e):
+                raise
+
+            logging.warning(f'Reconnecting after connection error: {e}')
+            self.count('reconnects')
+
+            with self.connection() as sql:
+                return sql.load_data(query, columns, **kwargs)
+
+    def load_data_chunks(self, query, columns, **kwargs):
+        with self.connection() as sql:
+            yield from sql.load_data_chunks(query, columns, **kwargs)
+
+    def run_query(self, query, **params):
+        return self.load_data(query.sql, query.columns, params=query.bind(**params))
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            counts = dict(self.counts)
+
+        return {
+            'size': self.size,
+            'idle': self.idle.qsize(),
+            'checkouts': counts.pop('checkouts', 0),
+            'wait_mean': sum(waits) / len(waits) if waits else 0,
+            'wait_p95': waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0,
+            'wait_max': waits[-1] if waits else 0,
+            **counts
+        }
+
+
+def is_connection_error(e):
+    return bool(e.args) and e.args[0] in CONNECTION_ERROR_STATES
+
+
+class BoundedRetry(Retry):
+    def get_backoff_time(self):
+        return min(super().get_backoff_time(), HTTP_BACKOFF_MAX)
 
-        if verbose > 0:
-            print('{0}: {1} rows inserted'.format(table_name, len(data)))
 
+class RequestStats:
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self.latencies = defaultdict(lambda: deque(maxlen=self.maxlen))
+        self.statuses = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, response, *args, **kwargs):
+        host = urlparse(response.url).netloc
+
+        with self.lock:
+            self.latencies[host].append(response.elapsed.total_seconds())
+            self.statuses[response.status_code] += 1
+
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for host, latencies in self.latencies.items():
+                ordered = sorted(latencies)
+                summary[host] = {
+                    'requests': len(ordered),
+                    'mean': sum(ordered) / len(ordered),
+                    'p50': ordered[len(ordered) // 2],
+                    'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    'max': ordered[-1]
+                }
+
+            return summary
+
+    def log(self):
+        for host, stats in self.summary().items():
+            logging.info('{0}: {requests} requests, mean {mean:.3f}s, p50 {p50:.3f}s, p95 {p95:.3f}s, '
+                         'max {max:.3f}s'.format(host, **stats))
+
+        logging.info(f'Response statuses: {dict(self.statuses)}')
+
+
+request_stats = RequestStats()
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+    retry = BoundedRetry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    session.hooks['response'].append(request_stats.record)
+
+    return session
+
+
+def http_session():
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+
+        return _session
+
+
+def http_get(url, headers=None, params=None, timeout=HTTP_TIMEOUT):
+    return http_session().get(url, headers=headers, params=params, timeout=timeout)
+
+
+def get_content(base_url, h=headers, params=None, immutable=False):
+    """
+    raw response body for base_url, served from the response cache in replay mode or when immutable
+    immutable responses (eg. finished games) are never re-fetched once cached
+    """
+    url = requests.Request('GET', base_url, params=params).prepare().url
+
+    if replay_mode() or immutable:
+        content, cached_immutable = response_cache.get(url)
+
+        if content is not None and (replay_mode() or cached_immutable):
+            return content
+
+        if replay_mode():
+            logging.warning(f'Replay cache miss: {url}')
+            return None
+
+    rqst = http_get(base_url, headers=h, params=params)
+    print(rqst.status_code, base_url)
+
+    if rqst.status_code == 200:
+        response_cache.put(url, rqst.content, immutable)
+
+    return rqst.content
+
+
+def get_data(base_url, h=headers, params=None, immutable=False):
+    content = get_content(base_url, h, params, immutable)
+    if content is None:
+        return None
 
-def get_data(base_url, h=headers):
     try:
-        rqst = requests.request('GET', base_url, headers=h)
-        print(rqst.status_code, base_url)
-        return rqst.json()
+        return json.loads(content)
     except ValueError as e:
-        logging.info(e)
+        logging.warning(f'{base_url}: {e}')
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+_host_buckets = {}
+_host_buckets_lock = threading.Lock()
+
+
+def host_bucket(url, rate=FETCH_RATE, burst=FETCH_BURST):
+    host = urlparse(url).netloc
+
+    with _host_buckets_lock:
+        if host not in _host_buckets:
+            _host_buckets[host] = TokenBucket(rate, burst)
+
+        return _host_buckets[host]
+
+
+def fetch_iter(urls, fetch=get_data, max_workers=FETCH_WORKERS, rate=FETCH_RATE, burst=FETCH_BURST):
+    """
+    fetches urls on a thread pool, at most `rate` requests per second per host (None disables the limit)
+    yields results in the same order as urls, keeping at most 2 * max_workers requests in flight
+    """
+    def rate_limited_fetch(url):
+        if rate:
+            host_bucket(url, rate, burst).acquire()
+        return fetch(url)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+
+        for url in urls:
+            in_flight.append(executor.submit(rate_limited_fetch, url))
+
+            if len(in_flight) >= max_workers * 2:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def fetch_all(urls, **kwargs):
+    return list(fetch_iter(urls, **kwargs))
+
+
+def column_array(values, type_code):
+    """
+    typed array for one column of a result set, from the python type pyodbc reports for it
+    integer columns holding NULLs become float64, low cardinality strings become categoricals
+    """
+    has_nulls = any(v is None for v in values)
+
+    if type_code is bool and not has_nulls:
+        return np.array(values, dtype=bool)
+
+    if type_code is int:
+        return np.array(values, dtype=np.float64 if has_nulls else np.int64)
+
+    if type_code in (float, decimal.Decimal):
+        return np.array(values, dtype=np.float64)
+
+    if type_code in (datetime.datetime, datetime.date):
+        return pd.to_datetime(values).values
+
+    if type_code is str and CATEGORICAL_MIN_ROWS <= len(values) and \
+            len(set(values)) <= len(values) * CATEGORICAL_RATIO:
+        return pd.Categorical(values)
+
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def columnar_frame(columns, column_values, description):
+    if not column_values or not column_values[0]:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.DataFrame({i: column_array(values, d[1])
+                       for i, (values, d) in enumerate(zip(column_values, description))})
+    df.columns = columns
+
+    return df
 
 
 def create_logger(file_name):
@@ -158,9 +820,133 @@ def create_logger(file_name):
     logging.info('Task started')
 
 
+def column_definition(column_type):
+    """
+    columns are nullable unless their type says otherwise, eg. '[bigint] NOT NULL'
+    """
+    return column_type if column_type.upper().endswith('NULL') else column_type + ' NULL'
+
+
 def create_table_columns_statement(lst):
+    if isinstance(lst, dict):
+        return ', '.join(['[' + i + '] ' + column_definition(t) for i, t in lst.items()])
     if lst:
-        return ', '.join(['[' + i + '] [varchar](100) NULL' for i in lst])
+        return ', '.join(['[' + i + '] ' + DEFAULT_COLUMN_TYPE + ' NULL' for i in lst])
+
+
+def parse_column_type(column_type):
+    """
+    '[nvarchar](40)' -> ('nvarchar', 40), '[nvarchar](max)' -> ('nvarchar', -1), '[bigint] NOT NULL' -> ('bigint', None)
+    """
+    name, _, rest = column_type.partition(']')
+    length = rest.split(')')[0].strip(' (').lower() if '(' in rest else None
+
+    if length is not None:
+        length = -1 if length == 'max' else int(length)
+
+    return name.strip('[ ').lower(), length
+
+
+def value_fits(text, data_type, length):
+    if data_type in STRING_TYPES:
+        return length is None or length == -1 or len(text) <= length
+
+    if data_type in INTEGER_LIMITS:
+        return bool(INTEGER_PATTERN.match(text)) and abs(int(text)) < INTEGER_LIMITS[data_type]
+
+    if data_type in FLOAT_TYPES:
+        try:
+            float(text)
+            return True
+        except ValueError:
+            return False
+
+    if data_type == 'bit':
+        return text in BIT_STRINGS
+
+    if data_type in DATETIME_TYPES:
+        return bool(DATETIME_PATTERN.match(text))
+
+    return True
+
+
+def widened_column_type(values, data_type, length):
+    """
+    the type a column of data_type has to be altered to for every value to fit, or None when they already do
+    strings get longer, integers become bigint or float, anything else that doesn't fit becomes a string
+    """
+    texts = [parameter_value(v, data_type not in STRING_TYPES) for v in values]
+    texts = [t for t in texts if t is not None]
+
+    if all(value_fits(t, data_type, length) for t in texts):
+        return None
+
+    max_length = max(len(t) for t in texts)
+    if data_type in STRING_TYPES:
+        return '[{0}]({1})'.format(data_type, fitted_length(max_length))
+
+    if data_type in INTEGER_LIMITS or data_type == 'bit':
+        if all(value_fits(t, 'bigint', None) for t in texts):
+            return '[bigint]'
+
+    if data_type in INTEGER_LIMITS or data_type in FLOAT_TYPES or data_type == 'bit':
+        if all(value_fits(t, 'float', None) for t in texts):
+            return '[float]'
+
+    return '[nvarchar]({0})'.format(fitted_length(max_length))
+
+
+def fitted_length(max_length):
+    length = int(math.ceil(max(max_length * 1.5, 10) / 10.0)) * 10
+    return 'max' if length > 4000 else length
+
+
+def infer_column_type(values):
+    values = [v for v in values if v is not None and not (isinstance(v, str) and v in NULL_STRINGS)]
+
+    if not values:
+        return DEFAULT_COLUMN_TYPE
+
+    if all(isinstance(v, bool) for v in values):
+        return '[bit]'
+
+    if all(isinstance(v, numbers.Integral) and not isinstance(v, bool) for v in values):
+        # ids keep growing, and once a key is indexed its column can't be widened
+        return '[bigint]'
+
+    if all(isinstance(v, (numbers.Real, decimal.Decimal)) and not isinstance(v, bool) for v in values):
+        return '[float]'
+
+    if all(isinstance(v, str) and DATETIME_PATTERN.match(v) for v in values):
+        return '[datetime]'
+
+    max_length = max(len(parameter_value(v)) for v in values)
+    return '[nvarchar]({0})'.format(fitted_length(max_length))
+
+
+def infer_column_types(data, columns=None, sample_size=TYPE_SAMPLE_SIZE):
+    """
+    sql types for each column of a list of dicts, inferred from up to sample_size rows spread across the data
+    """
+    sample = data[::max(1, len(data) // sample_size)][:sample_size]
+
+    return {c: infer_column_type([d.get(c) for d in sample]) for c in columns or ordered_columns(data)}
+
+
+def probed_column_type(probe):
+    if not probe['non_null']:
+        return DEFAULT_COLUMN_TYPE
+
+    if not probe['not_bigint'] and not probe['leading_zeros']:
+        return '[bigint]'
+
+    if not probe['not_float'] and not probe['leading_zeros']:
+        return '[float]'
+
+    if not probe['not_datetime']:
+        return '[datetime]'
+
+    return '[nvarchar]({0})'.format(fitted_length(probe['max_length']))
 
 
 def convert_hex_to_rgba(team_colours):
@@ -205,6 +991,52 @@ def set_statement(lst, key_columns):
     return ', '.join([['[' + i + ']=Source.[' + i + ']' for i in l.keys() if i not in key_columns] for l in lst][0])
 
 
+def ordered_columns(lst):
+    columns = list(lst[0].keys())
+    seen = set(columns)
+
+    for d in lst[1:]:
+        for k in d.keys():
+            if k not in seen:
+                seen.add(k)
+                columns.append(k)
+
+    return columns
+
+
+def parameter_value(value, null_strings=False):
+    """
+    the string bound for a value, with null_strings empty and 'None' strings are NULL as they are for a typed column
+    """
+    if value is None:
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if null_strings and str(value).strip() in NULL_STRINGS:
+        return None
+    return str(value)
+
+
+def merge_statement(target_table, source_table, columns, key_columns):
+    keys = [c for c in columns if c in key_columns]
+    updates = [c for c in columns if c not in key_columns]
+
+    query = 'MERGE INTO {0} AS Target ' \
+            'USING {1} AS Source ' \
+            'ON {2} ' \
+            'WHEN NOT MATCHED THEN INSERT ( {3} ) VALUES ( {4} )'.format(
+                target_table,
+                source_table,
+                ' AND '.join(f'Target.[{c}]=Source.[{c}]' for c in keys),
+                ', '.join(f'[{c}]' for c in columns),
+                ', '.join(f'Source.[{c}]' for c in columns))
+
+    if updates:
+        query += ' WHEN MATCHED THEN UPDATE SET {0}'.format(', '.join(f'[{c}]=Source.[{c}]' for c in updates))
+
+    return query + ';'
+
+
 def insert_statement(table_name, columns):
     return f'''
 CREATE TABLE [dbo].[{table_name}]
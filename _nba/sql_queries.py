@@ -1,39 +1,123 @@
+class Query:
+    """
+    a query declared once with `?` markers and the name and type of the parameter bound to each marker, in order
+    executed with bound parameters, so SQL Server caches one plan per query instead of one per team/player/season
+    `tables` are the tables the query reads, a cached result is dropped when ingestion changes any of them
+    pyodbc binds a str as nvarchar, so a marker compared with a varchar column is cast to varchar in the sql. otherwise
+    SQL Server converts the column instead, which loses the index seeks and partition elimination on it
+    """
+    def __init__(self, name, sql, columns=None, params=(), tables=()):
+        self.name = name
+        self.sql = sql
+        self.columns = columns
+        self.params = params
+        self.tables = tables
 
-SHOT_PLOT_COLUMNS = ['ClockTime', 'Description', 'EType', 'Evt', 'LocationX', 'LocationY', 'Period', 'TeamID',
-                     'Opposition TeamID', 'PlayerID', 'GameID', 'Date', 'Season', 'Venue']
+    def bind(self, **kwargs):
+        return [None if kwargs[name] is None else param_type(kwargs[name]) for name, param_type in self.params]
 
-shot_chart_query = '''
+
+QUERIES = {}
+
+
+def register_query(name, sql, columns=None, params=(), tables=()):
+    QUERIES[name] = Query(name, sql, columns, params, tables)
+    return QUERIES[name]
+
+
+SHOT_COLUMNS = ['Season', 'GameID', 'Evt', 'PlayerID', 'TeamID', 'Opposition TeamID', 'Period', 'ClockTime',
+                'Description', 'EType', 'Made', 'LocationX', 'LocationY', 'Distance']
+
+# one page of a season's shots for a player or team, keyset paged on (gid, evt) so every page is an index seek
+shots_query = '''
 SET NOCOUNT ON;
-BEGIN
-SELECT TOP (1000)
-[cl]
-,[de]
-,[etype]
-,[evt]
-,[locX]
-,[locY]
-,[period]
-,[tid]
-,CASE WHEN tid = g.home_team_id THEN g.away_team_id ELSE home_team_id END [opp_tid]
-,[pid]
-,g.[game_id]
-,g.[date]
-,g.[season]
-,g.[venue]
-FROM [NBA].[dbo].[game_pbp] gp
-JOIN games g ON g.game_id = gp.gid
-WHERE gp.pid = {0} 
-AND gp.tid = {1} 
-AND g.season = '2019-2020'
-AND gp.etype IN (1,2) 
-AND [tid] IN (SELECT [team_id] FROM [nba].[dbo].[teams])
-END
+SELECT TOP (?)
+    [season]
+    ,[gid]
+    ,[evt]
+    ,[pid]
+    ,[tid]
+    ,[opp_tid]
+    ,[period]
+    ,[cl]
+    ,[de]
+    ,[etype]
+    ,[made]
+    ,[locX]
+    ,[locY]
+    ,[distance]
+FROM [dbo].[shots]
+WHERE [season] = CAST(? AS varchar(10))
+AND {0} = ?
+AND ([gid] > ? OR ([gid] = ? AND [evt] > ?))
+ORDER BY [gid], [evt]
 '''
 
+SHOT_PAGE_PARAMS = [('after_gid', int), ('after_gid', int), ('after_evt', int)]
+
+player_shots_query = register_query(
+    'player_shots', shots_query.format('[pid]'), SHOT_COLUMNS,
+    [('page_size', int), ('season', str), ('player_id', int)] + SHOT_PAGE_PARAMS, ['shots'])
+
+team_shots_query = register_query(
+    'team_shots', shots_query.format('[tid]'), SHOT_COLUMNS,
+    [('page_size', int), ('season', str), ('team_id', int)] + SHOT_PAGE_PARAMS, ['shots'])
+
+SHOT_STORE_COLUMNS = ['pid', 'tid', 'opp_tid', 'period', 'cl', 'de', 'etype', 'made', 'locX', 'locY', 'distance']
+
+# shots are the made (etype 1) and missed (etype 2) field goals in game_pbp, locX/locY are in tenths of a foot
+refresh_shots_query = register_query(
+    'refresh_shots', '''
+SET NOCOUNT ON;
+
+-- the target is limited to the refreshed games, so the shots they no longer have are deleted and no others
+WITH refreshed AS (
+    SELECT *
+    FROM [dbo].[shots]
+    WHERE [gid] IN (SELECT CAST([value] AS bigint) FROM STRING_SPLIT(?, ','))
+)
+MERGE refreshed AS t
+USING (
+    SELECT
+        g.[season]
+        ,gp.[gid]
+        ,gp.[evt]
+        ,gp.[pid]
+        ,gp.[tid]
+        ,CASE WHEN gp.[tid] = g.[home_team_id] THEN g.[away_team_id] ELSE g.[home_team_id] END AS [opp_tid]
+        ,gp.[period]
+        ,gp.[cl]
+        ,gp.[de]
+        ,gp.[etype]
+        ,CASE WHEN gp.[etype] = 1 THEN 1 ELSE 0 END AS [made]
+        ,gp.[locX]
+        ,gp.[locY]
+        ,ROUND(SQRT(SQUARE(CAST(gp.[locX] AS float)) + SQUARE(CAST(gp.[locY] AS float))) / 10, 1) AS [distance]
+    FROM [dbo].[game_pbp] gp
+    JOIN [dbo].[games] g ON g.game_id = gp.gid
+    WHERE gp.[gid] IN (SELECT CAST([value] AS bigint) FROM STRING_SPLIT(?, ','))
+    AND gp.[etype] IN (1, 2)
+    AND gp.[tid] IN (SELECT [team_id] FROM [dbo].[teams])
+) AS s
+ON t.[season] = s.[season] AND t.[gid] = s.[gid] AND t.[evt] = s.[evt]
+WHEN MATCHED THEN UPDATE SET 
+    {updates}
+    ,t.[LastUpdated] = getdate()
+WHEN NOT MATCHED THEN 
+    INSERT ([season], [gid], [evt], {columns}) 
+    VALUES (s.[season], s.[gid], s.[evt], {values})
+WHEN NOT MATCHED BY SOURCE THEN
+    DELETE;
+'''.format(
+    updates='\n    ,'.join(f't.[{c}] = s.[{c}]' for c in SHOT_STORE_COLUMNS),
+    columns=', '.join(f'[{c}]' for c in SHOT_STORE_COLUMNS),
+    values=', '.join(f's.[{c}]' for c in SHOT_STORE_COLUMNS)),
+    params=[('game_ids', str), ('game_ids', str)])
+
 CURRENT_ROSTER_COLUMNS = ['team_id', 'Season', 'league_id', 'Player', 'JerseyNumber', 'Position', 'Height', 'Weight',
                           'DoB', 'Age', 'Experience', 'School', 'player_id']
 
-team_roster_query = '''
+roster_query = '''
 SET NOCOUNT ON;
 BEGIN
 SELECT 
@@ -56,8 +140,7 @@ JOIN (
         [player_id]
         ,MAX([LastUpdated]) as Latest
     FROM [NBA].[dbo].[rosters]
-    WHERE [season] = 2019
-    AND [teamid] = {0}
+    WHERE [season] = 2019{0}
     GROUP BY [player_id]
 ) l 
     ON l.player_id = r.player_id
@@ -65,7 +148,19 @@ JOIN (
 END
 '''
 
-team_trend_query = '''
+team_roster_query = register_query(
+    'team_roster', roster_query.format(' AND [teamid] = CAST(? AS varchar(255))'), CURRENT_ROSTER_COLUMNS,
+    [('team_id', str)], ['rosters'])
+
+league_roster_query = register_query(
+    'league_roster', roster_query.format(''), CURRENT_ROSTER_COLUMNS, tables=['rosters'])
+
+TEAM_STATS_COLUMNS = ['tid', 'season', 'ast', 'games', 'blk', 'blka', 'dreb', 'fbpts', 'fbptsa',
+                      'fbptsm', 'fga', 'fgm', 'fta', 'ftm', 'oreb', 'pf', 'pip', 'pipa', 'pipm',
+                      'pts', 'reb', 'stl', 'tov', 'tpa', 'tpm']
+
+team_trend_query = register_query(
+    'team_trend', '''
 SET NOCOUNT ON;
 BEGIN
 SELECT 
@@ -122,7 +217,7 @@ FROM (
         ,SUM([tpa]) tpa
         ,SUM([tpm]) tpm
     FROM [NBA].[dbo].[game_stats]
-    WHERE [tid] = {0}
+    WHERE [tid] = ?
     GROUP BY [gid], [tid]
 ) gs
 JOIN games g ON g.game_id = gs.gid
@@ -130,9 +225,11 @@ GROUP BY
 [tid]
 ,g.season
 END
-'''
+''', TEAM_STATS_COLUMNS,
+    [('team_id', int)], ['game_stats', 'games'])
 
-team_compare_query = '''
+team_compare_query = register_query(
+    'team_compare', '''
 SET NOCOUNT ON;
 BEGIN
 SELECT 
@@ -192,7 +289,7 @@ FROM (
     FROM [NBA].[dbo].[game_stats] gs
     JOIN games g ON g.game_id = gs.gid
     WHERE [tid] IN (SELECT [team_id] FROM [nba].[dbo].[teams])
-    AND g.season = '{0}'
+    AND g.season = CAST(? AS varchar(10))
     GROUP BY 
         [tid]
         ,g.[season]
@@ -202,16 +299,93 @@ GROUP BY
     [tid]
     ,[season]
 END
-'''
+''', TEAM_STATS_COLUMNS,
+    [('season', str)], ['game_stats', 'games'])
 
-TEAM_STATS_COLUMNS = ['tid', 'season', 'ast', 'games', 'blk', 'blka', 'dreb', 'fbpts', 'fbptsa',
-                      'fbptsm', 'fga', 'fgm', 'fta', 'ftm', 'oreb', 'pf', 'pip', 'pipa', 'pipm',
-                      'pts', 'reb', 'stl', 'tov', 'tpa', 'tpm']
+# per team totals kept in team_game_stats and team_season_stats, refreshed by derived_tables after each load
+TEAM_STAT_TOTALS = [c for c in TEAM_STATS_COLUMNS if c not in ('tid', 'season', 'games')]
+
+refresh_team_stats_query = register_query(
+    'refresh_team_stats', '''
+SET NOCOUNT ON;
+
+MERGE [dbo].[team_game_stats] AS t
+USING (
+    SELECT 
+        gs.[gid]
+        ,gs.[tid]
+        ,g.[season]
+        ,COUNT(*) AS [players]
+        {sums}
+    FROM [dbo].[game_stats] gs
+    JOIN [dbo].[games] g ON g.game_id = gs.gid
+    WHERE gs.[gid] IN (SELECT CAST([value] AS bigint) FROM STRING_SPLIT(?, ','))
+    GROUP BY gs.[gid], gs.[tid], g.[season]
+) AS s
+ON t.[gid] = s.[gid] AND t.[tid] = s.[tid]
+WHEN MATCHED THEN UPDATE SET 
+    t.[season] = s.[season]
+    ,t.[players] = s.[players]
+    {updates}
+    ,t.[LastUpdated] = getdate()
+WHEN NOT MATCHED THEN 
+    INSERT ([gid], [tid], [season], [players], {columns}) 
+    VALUES (s.[gid], s.[tid], s.[season], s.[players], {values});
+
+MERGE [dbo].[team_season_stats] AS t
+USING (
+    SELECT 
+        tgs.[tid]
+        ,tgs.[season]
+        ,COUNT(*) AS [games]
+        {sums}
+    FROM [dbo].[team_game_stats] tgs
+    JOIN (
+        SELECT DISTINCT [tid], [season]
+        FROM [dbo].[team_game_stats]
+        WHERE [gid] IN (SELECT CAST([value] AS bigint) FROM STRING_SPLIT(?, ','))
+    ) c
+        ON c.[tid] = tgs.[tid] AND c.[season] = tgs.[season]
+    GROUP BY tgs.[tid], tgs.[season]
+) AS s
+ON t.[tid] = s.[tid] AND t.[season] = s.[season]
+WHEN MATCHED THEN UPDATE SET 
+    t.[games] = s.[games]
+    {updates}
+    ,t.[LastUpdated] = getdate()
+WHEN NOT MATCHED THEN 
+    INSERT ([tid], [season], [games], {columns}) 
+    VALUES (s.[tid], s.[season], s.[games], {values});
+'''.format(
+    sums='\n        '.join(f',SUM([{c}]) AS [{c}]' for c in TEAM_STAT_TOTALS),
+    updates='\n    '.join(f',t.[{c}] = s.[{c}]' for c in TEAM_STAT_TOTALS),
+    columns=', '.join(f'[{c}]' for c in TEAM_STAT_TOTALS),
+    values=', '.join(f's.[{c}]' for c in TEAM_STAT_TOTALS)),
+    params=[('game_ids', str), ('game_ids', str)])
+
+# same result as team_compare_query, read from the materialized totals. integer division matches AVG over bigint
+team_season_stats_query = register_query(
+    'team_season_stats', '''
+SET NOCOUNT ON;
+SELECT 
+    [tid]
+    ,[season]
+    {averages}
+FROM [dbo].[team_season_stats]
+WHERE [tid] IN (SELECT [team_id] FROM [nba].[dbo].[teams])
+AND [season] = CAST(? AS varchar(10))
+'''.format(
+    averages='\n    '.join(
+        ',[games]' if c == 'games' else f',[{c}] / NULLIF([games], 0) AS [{c}]' for c in TEAM_STATS_COLUMNS[2:])),
+    columns=TEAM_STATS_COLUMNS,
+    params=[('season', str)],
+    tables=['team_season_stats'])
 
 POSITION_CLUSTERS_COLUMNS = ['season', 'player_id',
                              'player_name', 'labels', 'tags', 'x1', 'x2']
 
-position_clusters_query = '''
+position_clusters_query = register_query(
+    'position_clusters', '''
 SET NOCOUNT ON;
 BEGIN
 SELECT 
@@ -223,56 +397,161 @@ SELECT
 ,[X1]
 ,[X2]
 FROM [nba].[dbo].[position_clusters]
-WHERE [Season] = '{0}'
+WHERE [Season] = ?
 END
-'''
+''', POSITION_CLUSTERS_COLUMNS,
+    [('season', str)], ['position_clusters'])
 
 
 SHOOTING_STATS_COLUMNS = ['season', 'player_id', 'Player', 'G', 'GS', 'FBPTS', 'FBPTSM', 'FBPTSA', 'FBPTS%', 'FGM', 'FGA',
                           'FG%', 'FTM', 'FTA', 'FT%', 'PIP', 'PIPM', 'PIPA', 'PIP%', 'PTS', '3PM', '3PA', '3P%']
 
-player_shooting_stats_query = '''
+# per player totals for each team and season kept in player_season_shooting, refreshed by derived_tables
+PLAYER_SHOOTING_TOTALS = ['fbpts', 'fbptsm', 'fbptsa', 'fgm', 'fga', 'ftm', 'fta', 'pip', 'pipm', 'pipa', 'pts', 'tpm',
+                          'tpa']
+
+refresh_player_shooting_query = register_query(
+    'refresh_player_shooting', '''
 SET NOCOUNT ON;
-BEGIN
-SELECT 
-    g.[season]
-    ,gs.[pid]
-    ,r.[player]
-    ,COUNT(gs.[gid]) [appearances]
-    ,SUM(CASE WHEN [pos] = '' THEN 0 ELSE 1 END) AS [starts]
-    ,SUM(CAST([fbpts] AS float)) fbpts
-    ,SUM(CAST([fbptsm] AS float)) fbptsm
-    ,SUM(CAST([fbptsa] AS float)) fbptsa
-    ,CASE WHEN SUM(CAST([fbptsa] AS float)) > 0 THEN ROUND(SUM(CAST([fbptsm] AS float)) / SUM(CAST([fbptsa] AS float)) * 100 , 1) ELSE 0 END [fbpts%]
-    ,SUM(CAST([fgm] AS float)) fgm
-    ,SUM(CAST([fga] AS float)) fga
-    ,CASE WHEN SUM(CAST([fga] AS float)) > 0 THEN ROUND(SUM(CAST([fgm] AS float)) / SUM(CAST([fga] AS float)) * 100 , 1) ELSE 0 END [fg%]
-    ,SUM(CAST([ftm] AS float)) ftm
-    ,SUM(CAST([fta] AS float)) fta
-    ,CASE WHEN SUM(CAST([fta] AS float)) > 0 THEN ROUND(SUM(CAST([ftm] AS float)) / SUM(CAST([fta] AS float)) * 100 , 1) ELSE 0 END [ft%]
-    ,SUM(CAST([pip] AS float)) pip
-    ,SUM(CAST([pipm] AS float)) pipm
-    ,SUM(CAST([pipa] AS float)) pipa
-    ,CASE WHEN SUM(CAST([pipa] AS float)) > 0 THEN ROUND(SUM(CAST([pipm] AS float)) / SUM(CAST([pipa] AS float)) * 100 , 1) ELSE 0 END [pip%]
-    ,SUM(CAST([pts] AS float)) pts
-    ,SUM(CAST([tpm] AS float)) tpm
-    ,SUM(CAST([tpa] AS float)) tpa
-    ,CASE WHEN SUM(CAST([tpa] AS float)) > 0 THEN ROUND(SUM(CAST([tpm] AS float)) / SUM(CAST([tpa] AS float)) * 100 , 1) ELSE 0 END [3p%]
-FROM [nba].[dbo].[game_stats] gs
-JOIN [nba].[dbo].[rosters] r ON r.player_id = gs.pid
-JOIN [nba].[dbo].[games] g ON g.game_id = gs.gid
-JOIN (
+
+MERGE [dbo].[player_season_shooting] AS t
+USING (
     SELECT 
+        g.[season]
+        ,gs.[tid]
+        ,gs.[pid]
+        ,MAX(CONCAT(gs.[fn], ' ', gs.[ln])) AS [player]
+        ,COUNT(*) AS [appearances]
+        ,SUM(CASE WHEN gs.[pos] = '' THEN 0 ELSE 1 END) AS [starts]
+        {sums}
+    FROM [dbo].[game_stats] gs
+    JOIN [dbo].[games] g ON g.game_id = gs.gid
+    JOIN (
+        SELECT DISTINCT g.[season], gs.[tid], gs.[pid]
+        FROM [dbo].[game_stats] gs
+        JOIN [dbo].[games] g ON g.game_id = gs.gid
+        WHERE gs.[gid] IN (SELECT CAST([value] AS bigint) FROM STRING_SPLIT(?, ','))
+    ) c
+        ON c.[season] = g.[season] AND c.[tid] = gs.[tid] AND c.[pid] = gs.[pid]
+    GROUP BY g.[season], gs.[tid], gs.[pid]
+) AS s
+ON t.[season] = s.[season] AND t.[tid] = s.[tid] AND t.[pid] = s.[pid]
+WHEN MATCHED THEN UPDATE SET 
+    t.[player] = s.[player]
+    ,t.[appearances] = s.[appearances]
+    ,t.[starts] = s.[starts]
+    {updates}
+    ,t.[LastUpdated] = getdate()
+WHEN NOT MATCHED THEN 
+    INSERT ([season], [tid], [pid], [player], [appearances], [starts], {columns}) 
+    VALUES (s.[season], s.[tid], s.[pid], s.[player], s.[appearances], s.[starts], {values});
+'''.format(
+    sums='\n        '.join(f',SUM(gs.[{c}]) AS [{c}]' for c in PLAYER_SHOOTING_TOTALS),
+    updates='\n    '.join(f',t.[{c}] = s.[{c}]' for c in PLAYER_SHOOTING_TOTALS),
+    columns=', '.join(f'[{c}]' for c in PLAYER_SHOOTING_TOTALS),
+    values=', '.join(f's.[{c}]' for c in PLAYER_SHOOTING_TOTALS)),
+    params=[('game_ids', str)])
+
+
+def shooting_percentage(made, attempted):
+    return (f'CASE WHEN [{attempted}] > 0 '
+            f'THEN ROUND(CAST([{made}] AS float) / [{attempted}] * 100, 1) ELSE 0 END AS [{made[:-1]}%]')
+
+
+player_season_shooting_query = register_query(
+    'player_season_shooting', '''
+SET NOCOUNT ON;
+SELECT 
     [season]
     ,[pid]
-    ,COUNT([gid]) AS [appearances]
-    FROM [nba].[dbo].[game_stats] gs
-    JOIN games g ON g.game_id = gs.gid
-    WHERE [tid] = {0}
-    AND [season] = '2019-2020'
-    GROUP BY [season], [pid]
-) a
-    ON a.[season] = g.[season] AND a.pid = gs.pid
-GROUP BY g.[season] ,gs.[pid] ,r.[player]
-END
+    ,[player]
+    ,[appearances]
+    ,[starts]
+    ,[fbpts]
+    ,[fbptsm]
+    ,[fbptsa]
+    ,{fbpts}
+    ,[fgm]
+    ,[fga]
+    ,{fg}
+    ,[ftm]
+    ,[fta]
+    ,{ft}
+    ,[pip]
+    ,[pipm]
+    ,[pipa]
+    ,{pip}
+    ,[pts]
+    ,[tpm]
+    ,[tpa]
+    ,{tp}
+FROM [dbo].[player_season_shooting]
+WHERE [tid] = ?
+AND [season] = CAST(? AS varchar(10))
+'''.format(
+    fbpts=shooting_percentage('fbptsm', 'fbptsa'),
+    fg=shooting_percentage('fgm', 'fga'),
+    ft=shooting_percentage('ftm', 'fta'),
+    pip=shooting_percentage('pipm', 'pipa'),
+    tp=shooting_percentage('tpm', 'tpa')),
+    columns=SHOOTING_STATS_COLUMNS,
+    params=[('team_id', int), ('season', str)],
+    tables=['player_season_shooting'])
+
+
+add_games_status_query = '''
+IF OBJECT_ID('[dbo].[games]') IS NOT NULL AND COL_LENGTH('[dbo].[games]', 'status') IS NULL
+ALTER TABLE [dbo].[games] ADD [status] [varchar](10) NULL
 '''
+
+INGESTED_GAMES_COLUMNS = ['game_id', 'away_score', 'home_score', 'status']
+
+ingested_games_query = register_query(
+    'ingested_games', '''
+SET NOCOUNT ON;
+IF OBJECT_ID('[dbo].[games]') IS NULL
+    SELECT TOP 0 NULL, NULL, NULL, NULL
+ELSE
+    SELECT 
+        [game_id]
+        ,[away_score]
+        ,[home_score]
+        ,[status]
+    FROM [dbo].[games]
+    WHERE [season] = CAST(? AS varchar(10))
+''', INGESTED_GAMES_COLUMNS,
+    [('season', str)], ['games'])
+
+
+DATA_GENERATION_COLUMNS = ['table_name', 'generation']
+
+# bumped by ingestion for every table it writes, cached query results are keyed on these generations
+data_generations_query = register_query(
+    'data_generations', '''
+SET NOCOUNT ON;
+IF OBJECT_ID('[dbo].[data_generation]') IS NULL
+    SELECT TOP 0 NULL, NULL
+ELSE
+    SELECT 
+        [table_name]
+        ,[generation]
+    FROM [dbo].[data_generation]
+''', DATA_GENERATION_COLUMNS)
+
+bump_generation_query = register_query(
+    'bump_generation', '''
+SET NOCOUNT ON;
+IF OBJECT_ID('[dbo].[data_generation]') IS NULL
+    CREATE TABLE [dbo].[data_generation]
+    (
+        [table_name] [varchar](128) NOT NULL PRIMARY KEY,
+        [generation] [bigint] NOT NULL,
+        [LastUpdated] [datetime] NOT NULL DEFAULT (getdate())
+    );
+
+MERGE [dbo].[data_generation] AS t
+USING (SELECT CAST(? AS varchar(128)) AS [table_name]) AS s
+ON t.[table_name] = s.[table_name]
+WHEN MATCHED THEN UPDATE SET t.[generation] = t.[generation] + 1, t.[LastUpdated] = getdate()
+WHEN NOT MATCHED THEN INSERT ([table_name], [generation]) VALUES (s.[table_name], 1);
+''', params=[('table_name', str)])
@@ -1,7 +1,6 @@
 import datetime
-import requests
 import collections
-from shared_modules import create_logger, get_data, SqlConnection
+from shared_modules import create_logger, get_data, http_get, request_stats, SqlConnection
 from nfl_settings import base_url, stat_types, headers, upsert_keys
 
 
@@ -41,7 +40,7 @@ def get_stats(season, stat, sql):
         season_phase = 'REG' if week <= 17 else 'POST'
         url = f'{base_url}/{stat}?season={season}&seasonType={season_phase}&week={week}'
 
-        query = requests.request('GET', url, headers=headers)
+        query = http_get(url, headers=headers)
 
         print(query.status_code, stat, season, week)
         play_stats.append(query.json())
@@ -73,6 +72,8 @@ def main():
     for stat in stat_types:
         get_stats(season, stat, sql)
 
+    request_stats.log()
+
 
 if __name__ == '__main__':
     main()